@@ -24,6 +24,10 @@ CACHE_DURATION_SNIPPET = 30
 
 global_config = config.get_global_config()
 
+chstrings.warm_strings_cache({
+    lang_code: config.get_frozen_localized_config(lang_code)
+    for lang_code in config.LANG_CODES_TO_LANG_NAMES})
+
 app = flask.Flask(__name__)
 flask_compress.Compress(app)
 debug = 'DEBUG' in os.environ
@@ -39,6 +43,7 @@ app.add_url_rule('/<lang_code>', view_func = handlers.citation_hunt,
 app.add_url_rule('/<lang_code>/stats.html', view_func = handlers.stats)
 if 'stats' not in global_config.flagged_off:
     app.after_request(handlers.log_request)
+app.teardown_appcontext(handlers.release_dbs)
 app.add_url_rule('/<lang_code>/search/category',
     view_func = handlers.search_category)
 app.add_url_rule('/<lang_code>/search/article',
@@ -64,7 +69,7 @@ def log_hello():
 @handlers.validate_lang_code
 def redirect(lang_code):
     to = urllib.parse.unquote(flask.request.args.get('to', ''))
-    cfg = config.get_localized_config(lang_code)
+    cfg = config.get_frozen_localized_config(lang_code)
     return flask.redirect(
         urllib.parse.urljoin('https://' + cfg.wikipedia_domain, to))
 
@@ -85,12 +90,17 @@ def add_cache_header(response):
     response.cache_control.max_age = CACHE_DURATION_SNIPPET
     return response
 
+@app.after_request
+def add_query_count_header(response):
+    response.headers['X-CH-Query-Count'] = str(handlers.get_query_count())
+    return response
+
 @app.errorhandler(404)
 def page_not_found(e):
     if hasattr(flask.g, '_cfg'):
         cfg = flask.g._cfg
     else:
-        cfg = config.get_localized_config('en')
+        cfg = config.get_frozen_localized_config('en')
     if hasattr(flask.g, '_strings'):
         lang_tag = flask.g._lang_tag
         strings = flask.g._strings
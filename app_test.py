@@ -19,6 +19,9 @@ import datetime
 import json
 import unittest
 
+# Saved before CitationHuntTest mocks it.
+_query_random_snippet = app.handlers.database.query_random_snippet
+
 class CitationHuntTest(unittest.TestCase):
     def setUp(self):
         self.app = app.app.test_client()
@@ -166,6 +169,25 @@ class CitationHuntTest(unittest.TestCase):
         response = self.app.get('/en?id=' + self.sid)
         self.assertEqual(response.status_code, 200)
 
+    def test_query_count_header(self):
+        response = self.app.get('/en')
+        self.assertEqual(response.status_code, 302)
+        # The database methods are mocked, so no queries are counted.
+        self.assertEqual(response.headers['X-CH-Query-Count'], '0')
+
+    def test_query_count_header_counts_statements(self):
+        db = mock.Mock()
+        db.cursor.return_value.fetchone.side_effect = [(10,), (self.sid,)]
+        with mock.patch('app.handlers.database.query_random_snippet',
+                wraps = _query_random_snippet), \
+                mock.patch('chdb.get_db_pool') as get_db_pool:
+            get_db_pool.return_value.get.return_value = db
+            response = self.app.get('/en')
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(self.get_url_args(response.location)['id'], self.sid)
+        # One statement for the number of snippets, one to pick a snippet.
+        self.assertEqual(response.headers['X-CH-Query-Count'], '2')
+
     def test_invalid_id_no_category(self):
         response = self.app.get('/en?id=invalid')
         self.assertEqual(response.status_code, 404)
@@ -3,8 +3,12 @@ import utils
 
 import MySQLdb
 
+import collections
 import contextlib
+import functools
 import os
+import re
+import threading
 import time
 import warnings
 
@@ -65,6 +69,67 @@ class _RetryingConnection(object):
     def __getattr__(self, name):
         return getattr(self.conn, name)
 
+class ConnectionPool(object):
+    '''
+    A thread-safe pool of connections created by `connect`.
+
+    At most `max_size` idle connections are kept around. Connections idle for
+    longer than `max_idle_s` are closed instead of reused, and those idle for
+    longer than `health_check_s` are pinged before being handed out again.
+    '''
+
+    def __init__(self, connect, max_size, max_idle_s, health_check_s,
+            clock = time.time):
+        self._connect = connect
+        self._max_size = max_size
+        self._max_idle_s = max_idle_s
+        self._health_check_s = health_check_s
+        self._clock = clock
+        self._idle = collections.deque()  # (connection, time returned)
+        self._lock = threading.Lock()
+
+    def get(self):
+        while True:
+            with self._lock:
+                if not self._idle:
+                    break
+                # Prefer the most recently used connection, letting the others
+                # reach max_idle_s if we don't need them.
+                conn, returned_at = self._idle.pop()
+            idle_s = self._clock() - returned_at
+            if idle_s > self._max_idle_s:
+                self._close(conn)
+                continue
+            if idle_s > self._health_check_s:
+                try:
+                    conn.ping()
+                except MySQLdb.Error:
+                    self._close(conn)
+                    continue
+            return conn
+        return self._connect()
+
+    def put(self, conn, discard = False):
+        if not discard:
+            with self._lock:
+                if len(self._idle) < self._max_size:
+                    self._idle.append((conn, self._clock()))
+                    return
+        self._close(conn)
+
+    def close(self):
+        '''Closes the idle connections.'''
+        with self._lock:
+            idle, self._idle = self._idle, collections.deque()
+        for conn, _ in idle:
+            self._close(conn)
+
+    def _close(self, conn):
+        try:
+            conn.close()
+        except MySQLdb.Error:
+            pass
+
 @contextlib.contextmanager
 def ignore_warnings():
     warnings.filterwarnings('ignore', category = MySQLdb.Warning)
@@ -94,10 +159,15 @@ def _connect_to_wp_mysql(cfg):
             'port': int(os.getenv('CH_LOCAL_SSH_PORT')), 'host': '127.0.0.1'})
     return _connect(**kwds)
 
+_tools_labs_user = None
+
 def _make_tools_labs_dbname(cursor, database, lang_code):
-    cursor.execute("SELECT SUBSTRING_INDEX(USER(), '@', 1)")
-    user = cursor.fetchone()[0]
-    return '%s__%s_%s' % (user, database, lang_code)
+    # The user never changes within a process, so only ask once.
+    global _tools_labs_user
+    if _tools_labs_user is None:
+        cursor.execute("SELECT SUBSTRING_INDEX(USER(), '@', 1)")
+        _tools_labs_user = cursor.fetchone()[0]
+    return '%s__%s_%s' % (_tools_labs_user, database, lang_code)
 
 def _use(cursor, database, lang_code):
     cursor.execute('USE %s' % _make_tools_labs_dbname(
@@ -135,7 +205,7 @@ def init_stats_db():
     return _RetryingConnection(connect_and_initialize)
 
 def init_wp_replica_db(lang_code):
-    cfg = config.get_localized_config(lang_code)
+    cfg = config.get_frozen_localized_config(lang_code)
     def connect_and_initialize():
         db = _connect_to_wp_mysql(cfg)
         with db.cursor() as cursor:
@@ -143,6 +213,96 @@ def init_wp_replica_db(lang_code):
         return db
     return _RetryingConnection(connect_and_initialize)
 
+_pools = {}
+_pools_lock = threading.Lock()
+
+def _get_pool(key, connect):
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            cfg = config.get_global_config()
+            pool = _pools[key] = ConnectionPool(connect,
+                cfg.db_pool_size, cfg.db_pool_max_idle_s,
+                cfg.db_pool_health_check_s)
+        return pool
+
+def get_db_pool(lang_code):
+    return _get_pool(
+        ('citationhunt', lang_code), functools.partial(init_db, lang_code))
+
+def get_stats_db_pool():
+    return _get_pool(('stats', 'global'), init_stats_db)
+
+_compact_id_re = re.compile('^[0-9a-f]{8}$')
+# Read once, as encode_id is called for every id we read or write.
+_compact_ids = config.get_global_config().compact_ids
+
+def encode_id(id):
+    '''
+    Converts a snippet, category or intersection id made by utils.mkid into
+    the value we store for it in the citationhunt tables. Returns None if `id`
+    can't be one of our ids, so it doesn't match any rows.
+    '''
+    if not _compact_ids:
+        return id
+    if not isinstance(id, str) or not _compact_id_re.match(id):
+        return None
+    return bytes.fromhex(id)
+
+def id_column_type():
+    '''
+    The column type for snippet, category and intersection ids in the
+    citationhunt tables.
+    '''
+    # With compact_ids, the ids from utils.mkid are stored as the 4 bytes
+    # they encode rather than as 8 hex characters (see encode_id).
+    if _compact_ids:
+        return 'BINARY(4)'
+    return 'VARCHAR(128)'
+
+def decode_id(value):
+    '''
+    Converts an id read from the citationhunt tables back into the format
+    utils.mkid makes.
+    '''
+    if isinstance(value, bytes):
+        return value.hex()
+    return value
+
+def live_tables_match_id_format(db):
+    '''
+    Returns whether the live citationhunt database stores ids in the format
+    selected by compact_ids, so its rows can be copied into the scratch
+    database.
+    '''
+    database, table = get_table_name(
+        db, 'citationhunt', 'snippets').split('.')
+    rows = db.execute_with_retry_s('''
+        SELECT DATA_TYPE FROM information_schema.COLUMNS
+        WHERE TABLE_SCHEMA = %s AND TABLE_NAME = %s AND
+        COLUMN_NAME = %s''', database, table, 'id')
+    if rows is None:
+        return False
+    return (utils.d(rows[0][0]).lower() == 'binary') == bool(_compact_ids)
+
+_window_functions_supported = None
+
+def supports_window_functions(cursor):
+    '''
+    Returns whether the server `cursor` is connected to supports window
+    functions (MySQL 8.0 or MariaDB 10.2 and later). Only checked once, as
+    all of our databases live on the same server.
+    '''
+    global _window_functions_supported
+    if _window_functions_supported is None:
+        cursor.execute('SELECT VERSION()')
+        version = utils.d(cursor.fetchone()[0])
+        m = re.match(r'(\d+)\.(\d+)', version)
+        major_minor = tuple(map(int, m.groups())) if m else (0, 0)
+        minimum = (10, 2) if 'mariadb' in version.lower() else (8, 0)
+        _window_functions_supported = major_minor >= minimum
+    return _window_functions_supported
+
 def get_en_projectindex_database_name():
     return 's52475__wpx_p'
 
@@ -150,64 +310,153 @@ def get_en_projectindex_database_name():
 # databases, help populate the scratch database and swap it with the serving
 # database.
 
+# Secondary indexes on the citationhunt tables, as (table, index name, columns).
+# These are added by _add_citationhunt_indexes rather than in the CREATE TABLE
+# statements, so that tables created before an index was introduced get it too.
+_CITATIONHUNT_INDEXES = [
+    # For query_next_id_in_category and query_next_id_in_intersection, which
+    # the index covers.
+    ('snippets_links', 'cat_id_prev', '(cat_id, prev, next)'),
+    ('snippets_links', 'inter_id_prev', '(inter_id, prev, next)'),
+    # For joining categories to their articles in populate_snippets_links.
+    ('articles_categories', 'category_id_article_id',
+        '(category_id, article_id)'),
+    # For finding the ordinal of the current snippet when computing the next
+    # one with snippet_navigation = 'ordinals'.
+    ('categories_snippets', 'category_id_snippet_id',
+        '(category_id, snippet_id)'),
+    ('intersections_snippets', 'inter_id_snippet_id',
+        '(inter_id, snippet_id)'),
+]
+
+# Columns added after the tables were first created, as (table, column,
+# definition). CREATE TABLE IF NOT EXISTS leaves existing tables alone, so
+# _add_citationhunt_columns adds these to the tables that don't have them.
+_CITATIONHUNT_COLUMNS = [
+    ('snippets', 'seq', 'INT(8) UNSIGNED UNIQUE'),
+    ('articles', 'rev_id', 'INT(10) UNSIGNED'),
+]
+
+def _add_citationhunt_columns(cursor):
+    for table, column, definition in _CITATIONHUNT_COLUMNS:
+        cursor.execute('''
+            SELECT COUNT(*) FROM information_schema.COLUMNS
+            WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND
+            COLUMN_NAME = %s''', (table, column))
+        if not cursor.fetchone()[0]:
+            cursor.execute('ALTER TABLE %s ADD COLUMN %s %s' % (
+                table, column, definition))
+
+def _add_citationhunt_indexes(cursor):
+    for table, index, columns in _CITATIONHUNT_INDEXES:
+        cursor.execute('''
+            SELECT COUNT(*) FROM information_schema.STATISTICS
+            WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND
+            INDEX_NAME = %s''', (table, index))
+        if not cursor.fetchone()[0]:
+            cursor.execute(
+                'ALTER TABLE %s ADD INDEX %s %s' % (table, index, columns))
+
 def _create_citationhunt_tables(cfg, cursor):
+    id_type = id_column_type()
     cursor.execute('''
-        CREATE TABLE IF NOT EXISTS categories (id VARCHAR(128) PRIMARY KEY,
+        CREATE TABLE IF NOT EXISTS categories (id {id} PRIMARY KEY,
         title VARCHAR(255)) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4
-    ''')
+    '''.format(id = id_type))
     cursor.execute('''
-        INSERT IGNORE INTO categories VALUES("unassigned", "unassigned")
-    ''')
+        INSERT IGNORE INTO categories VALUES(%s, "unassigned")
+    ''', (encode_id(utils.mkid('unassigned'))
+        if _compact_ids else 'unassigned',))
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS intersections (
-        id VARCHAR(128) PRIMARY KEY, expiration DATETIME)
+        id {id} PRIMARY KEY, expiration DATETIME)
         ENGINE=InnoDB DEFAULT CHARSET=utf8mb4
-    ''')
+    '''.format(id = id_type))
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS articles (page_id INT(8) UNSIGNED
-        PRIMARY KEY, url VARCHAR(512), title VARCHAR(512))
-        ENGINE=InnoDB DEFAULT CHARSET=utf8mb4
+        PRIMARY KEY, url VARCHAR(512), title VARCHAR(512),
+        rev_id INT(10) UNSIGNED) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4
     ''')
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS articles_categories (
-        article_id INT(8) UNSIGNED, category_id VARCHAR(128),
+        article_id INT(8) UNSIGNED, category_id {id},
         FOREIGN KEY(article_id) REFERENCES articles(page_id)
         ON DELETE CASCADE,
         FOREIGN KEY(category_id) REFERENCES categories(id)
         ON DELETE CASCADE) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4
-    ''')
+    '''.format(id = id_type))
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS articles_intersections (
-        article_id INT(8) UNSIGNED, inter_id VARCHAR(128),
+        article_id INT(8) UNSIGNED, inter_id {id},
         PRIMARY KEY(article_id, inter_id),
         FOREIGN KEY(article_id) REFERENCES articles(page_id)
         ON DELETE CASCADE,
         FOREIGN KEY(inter_id) REFERENCES intersections(id)
         ON DELETE CASCADE)
         ENGINE=InnoDB DEFAULT CHARSET=utf8mb4
-    ''')
+    '''.format(id = id_type))
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS category_article_count (
-        category_id VARCHAR(128), article_count INT(8) UNSIGNED,
+        category_id {id}, article_count INT(8) UNSIGNED,
         FOREIGN KEY(category_id) REFERENCES categories(id)
         ON DELETE CASCADE) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4
-    ''')
+    '''.format(id = id_type))
     cursor.execute('''
-        CREATE TABLE IF NOT EXISTS snippets (id VARCHAR(128) PRIMARY KEY,
+        CREATE TABLE IF NOT EXISTS snippets (id {id} PRIMARY KEY,
         snippet VARCHAR(%s), section VARCHAR(768), article_id INT(8)
-        UNSIGNED, oldest_template_date DATETIME, FOREIGN KEY(article_id)
+        UNSIGNED, oldest_template_date DATETIME, seq INT(8) UNSIGNED,
+        UNIQUE KEY(seq), FOREIGN KEY(article_id)
         REFERENCES articles(page_id) ON DELETE CASCADE) ENGINE=InnoDB
         DEFAULT CHARSET=utf8mb4
-    ''', (cfg.snippet_max_size * 10,))
+    '''.format(id = id_type), (cfg.snippet_max_size * 10,))
+    # Dense per-category and per-intersection sequences of snippets, ordered
+    # by article title, so that picking a random snippet is a count lookup
+    # followed by a point lookup on (id, ordinal).
     cursor.execute('''
-        CREATE TABLE IF NOT EXISTS snippets_links (prev VARCHAR(128),
-        next VARCHAR(128), cat_id VARCHAR(128), inter_id VARCHAR(128),
+        CREATE TABLE IF NOT EXISTS categories_snippets (
+        category_id {id}, ordinal INT(8) UNSIGNED,
+        snippet_id {id}, PRIMARY KEY(category_id, ordinal),
+        FOREIGN KEY(category_id) REFERENCES categories(id) ON DELETE CASCADE,
+        FOREIGN KEY(snippet_id) REFERENCES snippets(id) ON DELETE CASCADE)
+        ENGINE=InnoDB DEFAULT CHARSET=utf8mb4
+    '''.format(id = id_type))
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS category_snippet_count (
+        category_id {id} PRIMARY KEY, snippet_count INT(8) UNSIGNED,
+        FOREIGN KEY(category_id) REFERENCES categories(id)
+        ON DELETE CASCADE) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4
+    '''.format(id = id_type))
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS intersections_snippets (
+        inter_id {id}, ordinal INT(8) UNSIGNED,
+        snippet_id {id}, PRIMARY KEY(inter_id, ordinal),
+        FOREIGN KEY(inter_id) REFERENCES intersections(id) ON DELETE CASCADE,
+        FOREIGN KEY(snippet_id) REFERENCES snippets(id) ON DELETE CASCADE)
+        ENGINE=InnoDB DEFAULT CHARSET=utf8mb4
+    '''.format(id = id_type))
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS intersection_snippet_count (
+        inter_id {id} PRIMARY KEY, snippet_count INT(8) UNSIGNED,
+        FOREIGN KEY(inter_id) REFERENCES intersections(id)
+        ON DELETE CASCADE) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4
+    '''.format(id = id_type))
+    # Identifies the database installed by install_scratch_db, so the
+    # serving frontend can tell when to drop its caches.
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS generation (installed_ts DATETIME)
+        ENGINE=InnoDB DEFAULT CHARSET=utf8mb4
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS snippets_links (prev {id},
+        next {id}, cat_id {id}, inter_id {id},
         FOREIGN KEY(prev) REFERENCES snippets(id) ON DELETE CASCADE,
         FOREIGN KEY(next) REFERENCES snippets(id) ON DELETE CASCADE,
         FOREIGN KEY(cat_id) REFERENCES categories(id) ON DELETE CASCADE,
         FOREIGN KEY(inter_id) REFERENCES intersections(id) ON DELETE CASCADE)
         ENGINE=InnoDB DEFAULT CHARSET=utf8mb4
-    ''')
+    '''.format(id = id_type))
+    _add_citationhunt_columns(cursor)
+    _add_citationhunt_indexes(cursor)
 
 def _create_stats_tables(cfg, cursor):
     # No FOREIGN KEY for inter_id because we want to keep the stats even when
@@ -264,19 +513,18 @@ def install_scratch_db():
     with init_db(cfg.lang_code).cursor() as cursor:
         chname = _make_tools_labs_dbname(cursor, 'citationhunt', cfg.lang_code)
         scname = _make_tools_labs_dbname(cursor, 'scratch', cfg.lang_code)
-        # generate a sql query that will atomically swap tables in
-        # 'citationhunt' and 'scratch'. Modified from:
+        cursor.execute('DELETE FROM %s.generation' % scname)
+        cursor.execute('INSERT INTO %s.generation VALUES (NOW())' % scname)
+        # Atomically swap the tables in 'citationhunt' and 'scratch' with a
+        # single RENAME TABLE statement. We build it here rather than with
+        # GROUP_CONCAT, which silently truncates its result at
+        # group_concat_max_len. Modified from:
         # http://blog.shlomoid.com/2010/02/emulating-missing-rename-database.html
-        cursor.execute('''SET group_concat_max_len = 2048;''')
         cursor.execute('''
-            SELECT CONCAT('RENAME TABLE ',
-            GROUP_CONCAT('%s.', table_name,
-            ' TO ', table_schema, '.old_', table_name, ', ',
-            table_schema, '.', table_name, ' TO ', '%s.', table_name),';')
-            FROM information_schema.TABLES WHERE table_schema = '%s'
-            GROUP BY table_schema;
-        ''' % (chname, chname, scname))
-
-        rename_stmt = cursor.fetchone()[0]
-        cursor.execute(rename_stmt)
+            SELECT table_name FROM information_schema.TABLES
+            WHERE table_schema = %s''', (scname,))
+        tables = [utils.d(row[0]) for row in cursor.fetchall()]
+        cursor.execute('RENAME TABLE ' + ', '.join(
+            '{ch}.{t} TO {sc}.old_{t}, {sc}.{t} TO {ch}.{t}'.format(
+                ch = chname, sc = scname, t = table) for table in tables))
         cursor.execute('DROP DATABASE ' + scname)
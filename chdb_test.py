@@ -0,0 +1,287 @@
+import chdb
+import config
+import handlers.database as database
+
+import MySQLdb
+import flask
+import mock
+
+import os
+import unittest
+
+# The config file for a MySQL or MariaDB server the tests can create
+# databases in. The tests that need one are skipped if this isn't set.
+TEST_MY_CNF = os.getenv('CH_TEST_MY_CNF')
+
+class ConnectionPoolTest(unittest.TestCase):
+    def setUp(self):
+        self.now = 0
+        self.connect = mock.Mock(side_effect = lambda: mock.Mock())
+        self.pool = chdb.ConnectionPool(self.connect,
+            max_size = 2, max_idle_s = 300, health_check_s = 30,
+            clock = lambda: self.now)
+
+    def test_reuses_returned_connection(self):
+        conn = self.pool.get()
+        self.pool.put(conn)
+        self.assertIs(self.pool.get(), conn)
+        self.assertEqual(self.connect.call_count, 1)
+        conn.ping.assert_not_called()
+
+    def test_keeps_at_most_max_size(self):
+        conns = [self.pool.get() for _ in range(3)]
+        for conn in conns:
+            self.pool.put(conn)
+        conns[-1].close.assert_called_once_with()
+        self.assertEqual(
+            set([self.pool.get(), self.pool.get()]), set(conns[:2]))
+
+    def test_discard(self):
+        conn = self.pool.get()
+        self.pool.put(conn, discard = True)
+        conn.close.assert_called_once_with()
+        self.assertIsNot(self.pool.get(), conn)
+
+    def test_closes_connections_idle_for_too_long(self):
+        conn = self.pool.get()
+        self.pool.put(conn)
+        self.now += 301
+        self.assertIsNot(self.pool.get(), conn)
+        conn.close.assert_called_once_with()
+
+    def test_close(self):
+        conns = [self.pool.get() for _ in range(2)]
+        for conn in conns:
+            self.pool.put(conn)
+        self.pool.close()
+        for conn in conns:
+            conn.close.assert_called_once_with()
+        self.assertNotIn(self.pool.get(), conns)
+
+    def test_health_check(self):
+        healthy, broken = self.pool.get(), self.pool.get()
+        broken.ping.side_effect = MySQLdb.OperationalError
+        self.pool.put(healthy)
+        self.pool.put(broken)
+        self.now += 31
+        # The broken connection was returned last so it's tried first.
+        self.assertIs(self.pool.get(), healthy)
+        broken.close.assert_called_once_with()
+        healthy.ping.assert_called_once_with()
+
+class InstallScratchDbTest(unittest.TestCase):
+    def test_renames_all_tables(self):
+        tables = ['t%02d_%s' % (i, 'x' * 100) for i in range(20)]
+        cursor = mock.MagicMock()
+        cursor.fetchall.return_value = [(t.encode('utf-8'),) for t in tables]
+        db = mock.Mock()
+        db.cursor.return_value.__enter__ = mock.Mock(return_value = cursor)
+        db.cursor.return_value.__exit__ = mock.Mock(return_value = False)
+        with mock.patch.object(chdb, 'init_db', return_value = db), \
+                mock.patch.object(chdb, '_make_tools_labs_dbname',
+                    side_effect = lambda c, database, l: database + '_xx'), \
+                mock.patch.dict(os.environ, CH_LANG = 'en'):
+            chdb.install_scratch_db()
+        rename, = [c[0][0] for c in cursor.execute.call_args_list
+            if c[0][0].startswith('RENAME TABLE')]
+        for t in tables:
+            self.assertIn('citationhunt_xx.%s TO scratch_xx.old_%s, '
+                'scratch_xx.%s TO citationhunt_xx.%s' % (t, t, t, t), rename)
+        cursor.execute.assert_called_with('DROP DATABASE scratch_xx')
+
+class IdEncodingTest(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch.object(chdb, '_compact_ids', True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_round_trip(self):
+        encoded = chdb.encode_id('93b6f3cf')
+        self.assertEqual(encoded, b'\x93\xb6\xf3\xcf')
+        self.assertEqual(chdb.decode_id(encoded), '93b6f3cf')
+
+    def test_invalid_ids(self):
+        for id in ('', '93b6f3c', '93b6f3cf0', '93B6F3CF', 'zzzzzzzz',
+                '93 b6f3c', None):
+            self.assertIsNone(chdb.encode_id(id), id)
+
+    def test_disabled(self):
+        chdb._compact_ids = False
+        self.assertEqual(chdb.encode_id('93b6f3cf'), '93b6f3cf')
+        self.assertEqual(chdb.decode_id('93b6f3cf'), '93b6f3cf')
+
+class WindowFunctionsSupportTest(unittest.TestCase):
+    def supports_window_functions(self, version):
+        cursor = mock.Mock()
+        cursor.fetchone.return_value = (version,)
+        with mock.patch.object(chdb, '_window_functions_supported', None):
+            return chdb.supports_window_functions(cursor)
+
+    def test_versions(self):
+        self.assertTrue(self.supports_window_functions('8.0.36'))
+        self.assertTrue(self.supports_window_functions('10.4.32-MariaDB'))
+        self.assertTrue(self.supports_window_functions(b'10.11.6-MariaDB-log'))
+        self.assertFalse(self.supports_window_functions('5.7.44-log'))
+        self.assertFalse(self.supports_window_functions('10.1.48-MariaDB'))
+        self.assertFalse(self.supports_window_functions('unknown'))
+
+@unittest.skipUnless(TEST_MY_CNF, 'CH_TEST_MY_CNF is not set')
+class MySQLTestCase(unittest.TestCase):
+    DATABASE = 'ch_test'
+
+    def setUp(self):
+        self.db = chdb._connect(read_default_file = TEST_MY_CNF)
+        self.addCleanup(self.db.close)
+        self.cursor = self.db.cursor()
+        with chdb.ignore_warnings():
+            self.cursor.execute('DROP DATABASE IF EXISTS ' + self.DATABASE)
+        self.cursor.execute('CREATE DATABASE ' + self.DATABASE)
+        self.addCleanup(
+            self.cursor.execute, 'DROP DATABASE ' + self.DATABASE)
+        self.cursor.execute('USE ' + self.DATABASE)
+
+    def create_tables(self):
+        chdb._create_citationhunt_tables(
+            config.get_localized_config('en'), self.cursor)
+
+    def populate(self):
+        ids = [chdb.encode_id('%08x' % i) for i in range(4)]
+        links = list(zip(ids, ids[1:] + ids[:1]))
+        # Titles sort in the opposite order of the ids.
+        self.cursor.executemany(
+            'INSERT INTO articles VALUES (%s, "", %s, 1)',
+            [(i, 't%d' % (len(ids) - i)) for i in range(len(ids))])
+        self.cursor.executemany('''
+            INSERT INTO snippets (id, snippet, section, article_id)
+            VALUES (%s, "", "", %s)''', [(id, i) for i, id in enumerate(ids)])
+        self.cursor.execute(
+            'INSERT INTO categories VALUES (%s, "c")', (ids[0],))
+        self.cursor.execute(
+            'INSERT INTO intersections VALUES (%s, NOW())', (ids[0],))
+        self.cursor.executemany(
+            'INSERT INTO articles_categories VALUES (%s, %s)',
+            [(i, ids[0]) for i in range(len(ids))])
+        self.cursor.executemany(
+            'INSERT INTO snippets_links VALUES (%s, %s, %s, NULL)',
+            [(p, n, ids[0]) for p, n in links])
+        self.cursor.executemany(
+            'INSERT INTO snippets_links VALUES (%s, %s, NULL, %s)',
+            [(p, n, ids[0]) for p, n in links])
+        self.cursor.execute('ANALYZE TABLE snippets_links, articles_categories')
+        self.cursor.fetchall()
+        return ids
+
+    def explain(self, sql, args):
+        self.cursor.execute('EXPLAIN ' + sql, args)
+        columns = [d[0] for d in self.cursor.description]
+        return [dict(zip(columns, row)) for row in self.cursor.fetchall()]
+
+class IndexesTest(MySQLTestCase):
+    def assertUsesCoveringIndex(self, plan, table, index):
+        row, = [r for r in plan if r['table'] == table]
+        self.assertEqual(row['key'], index)
+        self.assertIn('Using index', row['Extra'] or '')
+
+    def test_next_id_in_category(self):
+        self.create_tables()
+        ids = self.populate()
+        self.assertUsesCoveringIndex(self.explain('''
+            SELECT next FROM snippets_links WHERE prev = %s
+            AND cat_id = %s''', (ids[1], ids[0])),
+            'snippets_links', 'cat_id_prev')
+
+    def test_next_id_in_intersection(self):
+        self.create_tables()
+        ids = self.populate()
+        self.assertUsesCoveringIndex(self.explain('''
+            SELECT next FROM snippets_links WHERE prev = %s
+            AND inter_id = %s''', (ids[1], ids[0])),
+            'snippets_links', 'inter_id_prev')
+
+    def test_articles_in_category(self):
+        self.create_tables()
+        ids = self.populate()
+        self.assertUsesCoveringIndex(self.explain('''
+            SELECT article_id FROM articles_categories
+            WHERE category_id = %s''', (ids[0],)),
+            'articles_categories', 'category_id_article_id')
+
+    def test_adds_indexes_to_existing_tables(self):
+        self.cursor.execute('''
+            CREATE TABLE snippets_links (prev VARCHAR(128),
+            next VARCHAR(128), cat_id VARCHAR(128), inter_id VARCHAR(128))
+            ENGINE=InnoDB DEFAULT CHARSET=utf8mb4''')
+        self.create_tables()
+        self.cursor.execute('SHOW INDEX FROM snippets_links')
+        columns = [d[0] for d in self.cursor.description]
+        indexes = set(
+            dict(zip(columns, row))['Key_name']
+            for row in self.cursor.fetchall())
+        self.assertTrue(
+            set(['cat_id_prev', 'inter_id_prev']).issubset(indexes))
+        # Running it again must not fail trying to add them twice.
+        self.create_tables()
+
+class ColumnsMigrationTest(MySQLTestCase):
+    def columns(self, table):
+        self.cursor.execute('SHOW COLUMNS FROM ' + table)
+        return set(row[0] for row in self.cursor.fetchall())
+
+    def test_adds_columns_to_existing_tables(self):
+        self.cursor.execute('''
+            CREATE TABLE snippets (id VARCHAR(128) PRIMARY KEY,
+            snippet VARCHAR(1024), section VARCHAR(768),
+            article_id INT(8) UNSIGNED, oldest_template_date DATETIME)
+            ENGINE=InnoDB DEFAULT CHARSET=utf8mb4''')
+        self.cursor.execute('''
+            CREATE TABLE articles (page_id INT(8) UNSIGNED PRIMARY KEY,
+            url VARCHAR(512), title VARCHAR(512))
+            ENGINE=InnoDB DEFAULT CHARSET=utf8mb4''')
+        self.create_tables()
+        self.assertIn('seq', self.columns('snippets'))
+        self.assertIn('rev_id', self.columns('articles'))
+        # Running it again must not fail trying to add them twice.
+        self.create_tables()
+
+class SnippetsLinksTest(MySQLTestCase):
+    def populate_links(self, use_window_functions):
+        with mock.patch.object(chdb, '_window_functions_supported',
+                use_window_functions):
+            database.populate_snippets_links(
+                self.cursor, category_ids = [self.ids[0]])
+        result = []
+        for table in ('snippets_links', 'categories_snippets',
+                'category_snippet_count'):
+            self.cursor.execute('SELECT * FROM ' + table)
+            result.append(sorted(self.cursor.fetchall()))
+            self.cursor.execute('DELETE FROM ' + table)
+        return result
+
+    def test_window_functions_match_python(self):
+        self.create_tables()
+        self.ids = self.populate()
+        self.cursor.execute('DELETE FROM snippets_links')
+        if not chdb.supports_window_functions(self.cursor):
+            self.skipTest('the server does not support window functions')
+        in_python = self.populate_links(False)
+        self.assertEqual(len(in_python[0]), len(self.ids))
+        self.assertEqual(self.populate_links(True), in_python)
+
+    def test_next_id_by_ordinal_matches_links(self):
+        self.create_tables()
+        self.ids = self.populate()
+        self.cursor.execute('DELETE FROM snippets_links')
+        database.populate_snippets_links(
+            self.cursor, category_ids = [self.ids[0]])
+        cat_id = chdb.decode_id(self.ids[0])
+        with flask.Flask(__name__).app_context(), \
+                mock.patch.object(database, 'get_db', return_value = self.db):
+            for id in map(chdb.decode_id, self.ids):
+                by_link = database.query_next_id_in_category('en', id, cat_id)
+                with mock.patch.object(database._global_config,
+                        'snippet_navigation', 'ordinals'):
+                    self.assertEqual(database.query_next_id_in_category(
+                        'en', id, cat_id), by_link)
+
+if __name__ == '__main__':
+    unittest.main()
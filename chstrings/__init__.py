@@ -162,13 +162,45 @@ def _partition_js_strings(strings):
         if k.startswith('js-'):
             strings['js'][k[3:]] = strings.pop(k)
 
+_STRINGS_DIR = os.path.dirname(__file__)
+
+# The lang tags we have strings for. Only these get cached below, as the
+# lang tags we're asked for come from request headers.
+_AVAILABLE_LANG_TAGS = set(
+    f[:-len('.json')] for f in os.listdir(_STRINGS_DIR) if f.endswith('.json'))
+
+# Fully preprocessed strings, keyed by (lang_code, lowercase lang_tag).
+_strings_cache = {}
+
 def _load_strings_for_lang_tag(lang_tag):
-    strings_dir = os.path.dirname(__file__)
-    json_path = os.path.join(strings_dir, lang_tag.lower() + '.json')
+    json_path = os.path.join(_STRINGS_DIR, lang_tag.lower() + '.json')
     with open(json_path) as json_fp:
         return json.load(json_fp)
 
+def _copy_strings(strings):
+    # The values are immutable, so this is enough to keep callers from
+    # modifying the cached strings.
+    strings = dict(strings)
+    if 'js' in strings:
+        strings['js'] = dict(strings['js'])
+    return strings
+
+def warm_strings_cache(lang_codes_to_configs):
+    '''Preprocess the strings for all lang tags each config may use.'''
+    for lang_code, config in lang_codes_to_configs.items():
+        for lang_tag in [lang_code] + list(config.accept_language):
+            get_localized_strings(config, lang_tag)
+
 def get_localized_strings(config, lang_tag):
+    key = (config.lang_code, lang_tag.lower())
+    strings = _strings_cache.get(key)
+    if strings is None:
+        strings = _make_localized_strings(config, lang_tag)
+        if key[1] in _AVAILABLE_LANG_TAGS:
+            _strings_cache[key] = strings
+    return _copy_strings(strings)
+
+def _make_localized_strings(config, lang_tag):
     localized_strings = {}
     try:
         localized_strings = _load_strings_for_lang_tag(lang_tag)
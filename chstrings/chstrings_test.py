@@ -43,6 +43,26 @@ class CHStringsTest(unittest.TestCase):
             self.assertEqual(fallback_strings['instructions_goal'],
                 strings['instructions_goal'])
 
+    def test_strings_are_cached(self):
+        gcfg = config.get_global_config()
+        cfg = config.get_localized_config(gcfg.fallback_lang_tag)
+        strings = chstrings.get_localized_strings(cfg, 'en')
+        with mock.patch('chstrings._load_strings_for_lang_tag') as m:
+            self.assertEqual(
+                strings, chstrings.get_localized_strings(cfg, 'EN'))
+            m.assert_not_called()
+
+    def test_cached_strings_cant_be_modified(self):
+        gcfg = config.get_global_config()
+        cfg = config.get_localized_config(gcfg.fallback_lang_tag)
+        strings = chstrings.get_localized_strings(cfg, 'en')
+        tooltitle = strings['tooltitle']
+        strings['tooltitle'] = 'Modified'
+        strings['js'].clear()
+        strings = chstrings.get_localized_strings(cfg, 'en')
+        self.assertEqual(tooltitle, strings['tooltitle'])
+        self.assertNotEqual({}, strings['js'])
+
     def test_missing_lang_tag_has_no_fallback(self):
         # We must only apply the fallback strings if there is an incomplete
         # strings file (test_fallback_lang_tag exercises that behavior).
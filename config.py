@@ -1,7 +1,10 @@
 #-*- encoding: utf-8 -*-
 
 import datetime
+import json
 import os
+import tempfile
+import time
 import types
 from functools import reduce
 
@@ -26,6 +29,21 @@ _GLOBAL_CONFIG = dict(
     # Where to put various logs
     log_dir = os.path.join(os.path.expanduser('~'), 'ch_logs'),
 
+    # Where to keep data cached across runs of our scripts
+    cache_dir = os.path.join(os.path.expanduser('~'), 'ch_cache'),
+
+    # How long before we look up the redirects to citation needed templates
+    # again (see Config.enable_wikipedia_api).
+    template_redirects_cache_ttl_hours = 24,
+
+    # parse_live.py caches the HTML for the sections it renders, up to this
+    # size (0 disables the cache)...
+    html_cache_max_size_mb = 1024,
+
+    # ...and re-renders them after this long, in case the templates in them
+    # changed.
+    html_cache_max_age_days = 30,
+
     # The lang_tag to use for untranslated strings.
     fallback_lang_tag = 'en',
 
@@ -35,6 +53,16 @@ _GLOBAL_CONFIG = dict(
 
     stats_max_age_days = 90,
 
+    # Requests are logged to the stats database from a background thread,
+    # in batches of up to this many rows...
+    stats_log_batch_size = 100,
+
+    # ...written at least this often...
+    stats_log_flush_interval_ms = 1000,
+
+    # ...and queued up to this many rows, past which we drop them.
+    stats_log_queue_size = 10000,
+
     user_agent = 'citationhunt (https://tools.wmflabs.org/citationhunt)',
 
     petscan_url = 'https://petscan.wmflabs.org',
@@ -53,6 +81,63 @@ _GLOBAL_CONFIG = dict(
     # How long before an intersection is deleted from the database.
     intersection_expiration_days = 30,
 
+    # How many idle database connections each serving process keeps around
+    # per database. Keep in mind Toolforge limits us to 20 connections per
+    # user (https://phabricator.wikimedia.org/T216170).
+    db_pool_size = 2,
+
+    # Idle connections are closed after this long...
+    db_pool_max_idle_s = 300,
+
+    # ...and pinged before being reused if idle for more than this.
+    db_pool_health_check_s = 30,
+
+    # How many snippets each serving process keeps in memory...
+    snippet_cache_size = 4096,
+
+    # ...and how often it checks whether a new database was installed, which
+    # invalidates them.
+    snippet_cache_generation_check_s = 60,
+
+    # Whether to store snippet, category and intersection ids as 4-byte
+    # binary strings instead of 8 hex characters in the citationhunt tables.
+    # The first rebuild after changing this parses every article again and
+    # drops the existing intersections, as they can't be copied over.
+    compact_ids = False,
+
+    # How to find the next snippet in a category or intersection: 'links'
+    # looks it up in the snippets_links table, while 'ordinals' computes it
+    # from the position of the current snippet in the category or
+    # intersection, so snippets_links doesn't need to be built at all.
+    snippet_navigation = 'links',
+
+    # Whether to only parse the articles that changed since the last time we
+    # built the database, copying over the snippets for the rest.
+    incremental_rebuild = False,
+
+    # Whether assign_categories.py should group pages by category in a
+    # database table rather than in memory, which bounds its memory usage
+    # regardless of how many categories there are.
+    streaming_category_assignment = False,
+
+    # How many connections to the Wikipedia database replica
+    # assign_categories.py uses to load categories concurrently. Keep in mind
+    # Toolforge limits us to 20 connections per user
+    # (https://phabricator.wikimedia.org/T216170).
+    assign_categories_replica_connections = 4,
+
+    # parse_live.py keeps up to this many Wikipedia API requests in flight...
+    parse_live_api_concurrency = 16,
+
+    # ...sending at most this many requests per second (0 means no limit)...
+    parse_live_api_requests_per_second = 50,
+
+    # ...while this many processes per CPU parse the articles...
+    parse_live_processes_per_cpu = 1,
+
+    # ...and up to this many articles are held in memory at a time.
+    parse_live_max_pending_articles = 256,
+
     api = types.SimpleNamespace(
         # Maximum number of snippets to return from our API methods.
         max_returned_snippets = 200,
@@ -93,6 +178,11 @@ _BASE_LANG_CONFIG = dict(
         'wrapoutputclass': '',
     },
 
+    # Whether to convert all sections of an article that need converting to
+    # HTML with a single call to the parse method, rather than one call per
+    # section (see SnippetParser.render_all).
+    batch_section_rendering = True,
+
     # What to extract for each citation needed template found in the wikitext,
     # either 'snippet' or 'section'
     extract = 'snippet',
@@ -1323,8 +1413,51 @@ def _resolve_redirects_to_templates(wikipedia, templates):
                 templates.add(tplname)
     return templates
 
+def _resolve_redirects_to_templates_cached(
+        wikipedia, templates, cache_path, ttl_s, refresh = False):
+    '''
+    Like _resolve_redirects_to_templates, but keeps the results in a JSON file
+    at `cache_path` and reuses them for `ttl_s` seconds, unless `refresh` is
+    passed.
+    '''
+    templates = sorted(set(templates))
+    if not refresh:
+        try:
+            with open(cache_path) as cache_f:
+                cached = json.load(cache_f)
+            if (cached['templates'] == templates and
+                time.time() - cached['timestamp'] < ttl_s):
+                return set(cached['resolved'])
+        except (OSError, ValueError, KeyError):
+            pass
+
+    resolved = _resolve_redirects_to_templates(wikipedia, templates)
+    try:
+        cache_dir = os.path.dirname(cache_path)
+        os.makedirs(cache_dir, exist_ok = True)
+        # Write to a temporary file first so that concurrent readers never
+        # see a partially written cache.
+        fd, tmp_path = tempfile.mkstemp(dir = cache_dir)
+        with os.fdopen(fd, 'w') as tmp_f:
+            json.dump({
+                'timestamp': time.time(),
+                'templates': templates,
+                'resolved': sorted(resolved),
+            }, tmp_f)
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        # Not being able to cache is fine, we'll just try again next time.
+        pass
+    return resolved
+
 class Config(types.SimpleNamespace):
-    def enable_wikipedia_api(self):
+    def enable_wikipedia_api(self, refresh_templates = False):
+        '''
+        Sets up self.wikipedia and expands self.citation_needed_templates with
+        the templates that redirect to them. The latter are cached on disk
+        (see template_redirects_cache_ttl_hours), pass `refresh_templates`
+        to look them up again regardless.
+        '''
         # This module is imported pretty often during some manual operations
         # (e.g. creating cronjobs), and yamwapi is the only third-party
         # dependency that would require us to enter the virtualenv so... as
@@ -1332,8 +1465,12 @@ class Config(types.SimpleNamespace):
         import yamwapi
         self.wikipedia = yamwapi.MediaWikiAPI(
             'https://' + self.wikipedia_domain + '/w/api.php', self.user_agent)
-        self.citation_needed_templates = _resolve_redirects_to_templates(
-            self.wikipedia, self.citation_needed_templates)
+        self.citation_needed_templates = _resolve_redirects_to_templates_cached(
+            self.wikipedia, self.citation_needed_templates,
+            os.path.join(self.cache_dir,
+                'template_redirects_%s.json' % self.lang_code),
+            self.template_redirects_cache_ttl_hours * 3600,
+            refresh_templates)
 
 def _inherit(base, child):
     ret = dict(base)  # shallow copy
@@ -1362,14 +1499,67 @@ assert len(
     set.union(set(), *list(LANG_CODES_TO_ACCEPT_LANGUAGE.values()))
 ) == sum(map(len, list(LANG_CODES_TO_ACCEPT_LANGUAGE.values())))
 
+class FrozenConfig(Config):
+    '''
+    A Config whose keys can't be modified, so it can be shared. Lists and
+    dicts are turned into tuples and read-only mappings.
+    '''
+
+    def __init__(self, **kwds):
+        super().__init__(**{k: _freeze(v) for k, v in kwds.items()})
+
+    def __setattr__(self, name, value):
+        raise AttributeError('cannot set %r on a FrozenConfig' % name)
+
+    def __delattr__(self, name):
+        raise AttributeError('cannot delete %r on a FrozenConfig' % name)
+
+    def enable_wikipedia_api(self, refresh_templates = False):
+        raise AttributeError(
+            'FrozenConfig does not support the Wikipedia API, '
+            'use get_localized_config instead')
+
+def _freeze(value):
+    # Copy lists and dicts as we freeze them, so changes to the original
+    # values don't show through.
+    if isinstance(value, list):
+        return tuple(_freeze(v) for v in value)
+    elif isinstance(value, dict):
+        return types.MappingProxyType(
+            {k: _freeze(v) for k, v in value.items()})
+    return value
+
 def get_global_config():
     return Config(**_GLOBAL_CONFIG)
 
+def _make_localized_config_dict(lang_code):
+    lang_config = _LANG_CODE_TO_CONFIG[lang_code]
+    return dict(
+        reduce(_inherit, [_GLOBAL_CONFIG, _BASE_LANG_CONFIG, lang_config]),
+        lang_code = lang_code,
+        lang_codes_to_lang_names = LANG_CODES_TO_LANG_NAMES)
+
 def get_localized_config(lang_code = None):
+    '''
+    Returns a new Config for `lang_code` (or the CH_LANG environment variable)
+    that the caller can modify, e.g. by calling enable_wikipedia_api.
+    '''
     if lang_code is None:
         lang_code = os.getenv('CH_LANG')
-    lang_config = _LANG_CODE_TO_CONFIG[lang_code]
-    cfg = Config(lang_code = lang_code, **reduce(
-        _inherit, [_GLOBAL_CONFIG, _BASE_LANG_CONFIG, lang_config]))
-    cfg.lang_codes_to_lang_names = LANG_CODES_TO_LANG_NAMES
-    return cfg
+    return Config(**_make_localized_config_dict(lang_code))
+
+_frozen_localized_configs = None
+
+def get_frozen_localized_config(lang_code):
+    '''
+    Returns the FrozenConfig for `lang_code`. These are built once for all
+    languages and shared, which makes this cheap enough to call on every
+    request.
+    '''
+    global _frozen_localized_configs
+    if _frozen_localized_configs is None:
+        _frozen_localized_configs = {
+            lc: FrozenConfig(**_make_localized_config_dict(lc))
+            for lc in _LANG_CODE_TO_CONFIG
+        }
+    return _frozen_localized_configs[lang_code]
@@ -1,6 +1,12 @@
 import config
 
+import mock
+
+import os
 import re
+import shutil
+import tempfile
+import time
 import unittest
 
 class ConfigTest(unittest.TestCase):
@@ -27,6 +33,78 @@ class ConfigTest(unittest.TestCase):
                 cfg.wikipedia_domain))
         setattr(cls, 'test_' + cfg.lang_code + '_wikipedia_domain', test)
 
+    def test_frozen_config_is_shared_and_read_only(self):
+        cfg = config.get_frozen_localized_config('en')
+        self.assertIs(cfg, config.get_frozen_localized_config('en'))
+        self.assertEqual(cfg.lang_code, 'en')
+        with self.assertRaises(AttributeError):
+            cfg.lang_code = 'pt'
+        with self.assertRaises(AttributeError):
+            cfg.enable_wikipedia_api()
+        with self.assertRaises(TypeError):
+            cfg.html_parse_parameters['text'] = ''
+
+    def test_frozen_config_matches_localized_config(self):
+        for lc in config.LANG_CODES_TO_LANG_NAMES:
+            cfg = config.get_localized_config(lc)
+            frozen = config.get_frozen_localized_config(lc)
+            self.assertEqual(cfg.citation_needed_templates,
+                list(frozen.citation_needed_templates))
+            self.assertEqual(cfg.wikipedia_domain, frozen.wikipedia_domain)
+
+    def test_freeze_copies_nested_values(self):
+        original = {'a': [1, {'b': 2}]}
+        frozen = config._freeze(original)
+        original['a'][1]['b'] = 3
+        original['c'] = 4
+        self.assertEqual(frozen['a'][1]['b'], 2)
+        self.assertNotIn('c', frozen)
+        with self.assertRaises(TypeError):
+            frozen['a'][1]['b'] = 3
+
+class TemplateRedirectsCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.cache_dir)
+        self.cache_path = os.path.join(self.cache_dir, 'subdir', 'en.json')
+        self.wikipedia = mock.Mock()
+        self.wikipedia.query.side_effect = lambda params: [{'query': {
+            'pages': {'1': {'redirects': [{'title': 'Template:Cn'}]}}}}]
+
+    def resolve(self, templates = ['Citation needed'], ttl_s = 3600,
+            refresh = False):
+        return config._resolve_redirects_to_templates_cached(
+            self.wikipedia, templates, self.cache_path, ttl_s, refresh)
+
+    def test_cached(self):
+        expected = set(['Citation needed', 'Cn'])
+        self.assertEqual(expected, self.resolve())
+        self.assertEqual(expected, self.resolve())
+        self.assertEqual(self.wikipedia.query.call_count, 1)
+
+    def test_expired(self):
+        self.resolve(ttl_s = 3600)
+        with mock.patch('config.time.time', return_value = time.time() + 7200):
+            self.resolve(ttl_s = 3600)
+        self.assertEqual(self.wikipedia.query.call_count, 2)
+
+    def test_refresh(self):
+        self.resolve()
+        self.resolve(refresh = True)
+        self.assertEqual(self.wikipedia.query.call_count, 2)
+
+    def test_different_templates(self):
+        self.resolve(['Citation needed'])
+        self.assertEqual(set(['Fact', 'Cn']), self.resolve(['Fact']))
+        self.assertEqual(self.wikipedia.query.call_count, 2)
+
+    def test_corrupt_cache(self):
+        self.resolve()
+        with open(self.cache_path, 'w') as f:
+            f.write('{')
+        self.assertEqual(set(['Citation needed', 'Cn']), self.resolve())
+        self.assertEqual(self.wikipedia.query.call_count, 2)
+
 if __name__ == '__main__':
     for lc in config.LANG_CODES_TO_LANG_NAMES:
         cfg = config.get_localized_config(lc)
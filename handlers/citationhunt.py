@@ -29,13 +29,7 @@ def select_random_id(lang_code, category, intersection):
         ret = database.query_snippet_by_intersection(lang_code, intersection)
 
     if ret is None:
-        # Try to pick one id at random. For small datasets, the probability
-        # of getting an empty set in a query is non-negligible, so retry a
-        # bunch of times as needed.
-        with log_time('select without category'):
-            for retry in range(1000):
-                ret = database.query_random_snippet(lang_code)
-                if ret: break
+        ret = database.query_random_snippet(lang_code)
 
     assert ret and len(ret) == 1
     return ret[0]
@@ -9,13 +9,71 @@ from datetime import datetime
 from dataclasses import dataclass
 import functools
 
+class _QueryCountingCursor(object):
+    '''
+    Wraps a database cursor, counting the statements executed through it
+    towards get_query_count.
+    '''
+
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def execute(self, *args, **kwds):
+        flask.g._query_count = get_query_count() + 1
+        return self._cursor.execute(*args, **kwds)
+
+    def executemany(self, *args, **kwds):
+        flask.g._query_count = get_query_count() + 1
+        return self._cursor.executemany(*args, **kwds)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def __enter__(self):
+        self._cursor.__enter__()
+        return self
+
+    def __exit__(self, *args):
+        return self._cursor.__exit__(*args)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+class _QueryCountingConnection(object):
+    '''
+    Wraps a chdb connection so that the statements executed in it are counted
+    towards get_query_count.
+    '''
+
+    def __init__(self, db):
+        self._db = db
+
+    def cursor(self, *args, **kwds):
+        return _QueryCountingCursor(self._db.cursor(*args, **kwds))
+
+    def execute_with_retry(self, operations, *args, **kwds):
+        def counting_operations(cursor, *args, **kwds):
+            return operations(_QueryCountingCursor(cursor), *args, **kwds)
+        return self._db.execute_with_retry(counting_operations, *args, **kwds)
+
+    def execute_with_retry_s(self, sql, *args):
+        def operations(cursor, sql, *args):
+            cursor.execute(sql, args)
+            if cursor.rowcount > 0:
+                return cursor.fetchall()
+            return None
+        return self.execute_with_retry(operations, sql, *args)
+
+    def __getattr__(self, name):
+        return getattr(self._db, name)
+
 def get_db(lang_code):
     localized_dbs = getattr(flask.g, '_localized_dbs', {})
     db = localized_dbs.get(lang_code, None)
     if db is None:
-        db = localized_dbs[lang_code] = chdb.init_db(lang_code)
+        db = localized_dbs[lang_code] = chdb.get_db_pool(lang_code).get()
     flask.g._localized_dbs = localized_dbs
-    return db
+    return _QueryCountingConnection(db)
 
 @contextlib.contextmanager
 def log_time(operation):
@@ -25,11 +83,30 @@ def log_time(operation):
     ms = (after - before).microseconds / 1000.
     flask.current_app.logger.debug('%s took %.2f ms', operation, ms)
 
+def get_query_count():
+    '''
+    The number of statements executed in connections from get_db and
+    get_stats_db in this request.
+    '''
+    return getattr(flask.g, '_query_count', 0)
+
 def get_stats_db():
     db = getattr(flask.g, '_stats_db', None)
     if db is None:
-        db = flask.g._stats_db = chdb.init_stats_db()
-    return db
+        db = flask.g._stats_db = chdb.get_stats_db_pool().get()
+    return _QueryCountingConnection(db)
+
+def release_dbs(exception):
+    # Return the connections borrowed by get_db and get_stats_db, unless
+    # something went wrong and they may be in a bad state.
+    discard = exception is not None
+    for lang_code, db in getattr(flask.g, '_localized_dbs', {}).items():
+        chdb.get_db_pool(lang_code).put(db, discard)
+    flask.g._localized_dbs = {}
+    stats_db = getattr(flask.g, '_stats_db', None)
+    if stats_db is not None:
+        chdb.get_stats_db_pool().put(stats_db, discard)
+        flask.g._stats_db = None
 
 def redirect_to_lang_code(lang_code):
     response = flask.redirect(
@@ -112,7 +189,7 @@ def validate_lang_code(handler):
         if lang_code not in config.LANG_CODES_TO_LANG_NAMES:
             return redirect_to_lang_code('en')
 
-        flask.g._cfg = config.get_localized_config(lang_code)
+        flask.g._cfg = config.get_frozen_localized_config(lang_code)
         if flask.current_app.debug and 'locale' in flask.request.args:
             flask.g._strings = chstrings.get_localized_strings(
                 flask.g._cfg, flask.request.args['locale'])
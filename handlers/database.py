@@ -2,70 +2,202 @@
 """
 
 import chdb
+import config
 from .common import *
 from utils import *
 
+import MySQLdb
+
 import itertools
+import random
+import time
+
+_global_config = config.get_global_config()
+
+# Snippets never change within a database, so we cache them keyed by the
+# database generation (see chdb.install_scratch_db) and let the entries from
+# previous generations age out.
+_snippet_cache = LRUCache(_global_config.snippet_cache_size)
+_generations = {}  # lang_code -> (generation, time of last check)
+
+# The ids we get from and return to the handlers are the ones from mkid, which
+# are converted to and from the format in our tables (see chdb.encode_id) only
+# in this module.
+
+def _fetch_id(cursor):
+    row = cursor.fetchone()
+    return (chdb.decode_id(row[0]),) if row is not None else None
 
 def query_category_by_id(lang_code, cat_id):
     cursor = get_db(lang_code).cursor()
     with log_time('get category by id'):
         cursor.execute('''
             SELECT id, title FROM categories WHERE id = %s
-        ''', (cat_id,))
-        return cursor.fetchone()
+        ''', (chdb.encode_id(cat_id),))
+        row = cursor.fetchone()
+    return (chdb.decode_id(row[0]), row[1]) if row is not None else None
+
+def query_generation(lang_code):
+    generation, checked_at = _generations.get(lang_code, (None, 0))
+    now = time.time()
+    if now - checked_at < _global_config.snippet_cache_generation_check_s:
+        return generation
+    cursor = get_db(lang_code).cursor()
+    with log_time('select generation'):
+        try:
+            cursor.execute('SELECT MAX(installed_ts) FROM generation')
+            row = cursor.fetchone()
+        except MySQLdb.ProgrammingError:
+            # The database was installed before we had a generation table.
+            row = None
+    generation = row[0] if row else None
+    _generations[lang_code] = (generation, now)
+    return generation
 
 def query_snippet_by_id(lang_code, id):
+    key = (lang_code, query_generation(lang_code), id)
+    sinfo = _snippet_cache.get(key)
+    lookups = _snippet_cache.hits + _snippet_cache.misses
+    if lookups % 1000 == 0:
+        flask.current_app.logger.info(
+            'snippet cache: %d hits, %d misses',
+            _snippet_cache.hits, _snippet_cache.misses)
+    if sinfo is not None:
+        return sinfo
+    db_id = chdb.encode_id(id)
+    if db_id is None:
+        return None
+
     cursor = get_db(lang_code).cursor()
     with log_time('select snippet by id'):
         cursor.execute('''
             SELECT snippets.snippet, snippets.section, articles.url,
             articles.title, snippets.oldest_template_date
             FROM snippets, articles WHERE snippets.id = %s
-            AND snippets.article_id = articles.page_id;''', (id,))
-        return cursor.fetchone()
+            AND snippets.article_id = articles.page_id;''', (db_id,))
+        sinfo = cursor.fetchone()
+    if sinfo is not None:
+        _snippet_cache.put(key, sinfo)
+    return sinfo
 
-def query_snippet_by_category(lang_code, cat_id):
+def _query_snippet_by_ordinal(lang_code, group_id, ordinals_table,
+        count_table, group_column, articles_table, articles_column):
     cursor = get_db(lang_code).cursor()
-    with log_time('select with category'):
+    try:
+        with log_time('count snippets in ' + group_column):
+            cursor.execute('''
+                SELECT snippet_count FROM ''' + count_table + '''
+                WHERE ''' + group_column + ''' = %s''',
+                (chdb.encode_id(group_id),))
+            count = cursor.fetchone()
+        if count is None or not count[0]:
+            return None
+        with log_time('select with ' + group_column):
+            cursor.execute('''
+                SELECT snippet_id FROM ''' + ordinals_table + '''
+                WHERE ''' + group_column + ''' = %s AND ordinal = %s;''',
+                (chdb.encode_id(group_id), random.randrange(count[0])))
+            return _fetch_id(cursor)
+    except MySQLdb.ProgrammingError:
+        # The database was installed before we had the ordinals tables, so
+        # fall back to a slower pick.
+        pass
+    with log_time('select with ' + group_column + ' by rand'):
         cursor.execute('''
-            SELECT snippets.id FROM snippets, articles_categories
-            WHERE snippets.article_id = articles_categories.article_id AND
-            articles_categories.category_id = %s ORDER BY RAND()
-            LIMIT 1;''', (cat_id,))
-        return cursor.fetchone()
+            SELECT snippets.id FROM snippets, ''' + articles_table + '''
+            WHERE snippets.article_id = ''' + articles_table + '''.article_id
+            AND ''' + articles_table + '.' + articles_column + ''' = %s
+            ORDER BY RAND() LIMIT 1;''', (chdb.encode_id(group_id),))
+        return _fetch_id(cursor)
+
+def query_snippet_by_category(lang_code, cat_id):
+    return _query_snippet_by_ordinal(lang_code, cat_id,
+        'categories_snippets', 'category_snippet_count', 'category_id',
+        'articles_categories', 'category_id')
 
 def query_snippet_by_intersection(lang_code, inter_id):
-    cursor = get_db(lang_code).cursor()
-    with log_time('select with category'):
-        cursor.execute('''
-            SELECT snippets.id FROM snippets, articles_intersections
-            WHERE snippets.article_id = articles_intersections.article_id AND
-            articles_intersections.inter_id = %s ORDER BY RAND()
-            LIMIT 1;''', (inter_id,))
-        return cursor.fetchone()
+    return _query_snippet_by_ordinal(lang_code, inter_id,
+        'intersections_snippets', 'intersection_snippet_count', 'inter_id',
+        'articles_intersections', 'inter_id')
 
 def query_random_snippet(lang_code):
     cursor = get_db(lang_code).cursor()
-    cursor.execute(
-        'SELECT id FROM snippets WHERE RAND() < 1e-4 LIMIT 1;')
-    return cursor.fetchone()
+    # The seq column is dense (see populate_snippets_seq), so this picks
+    # uniformly among all snippets.
+    with log_time('select max seq'):
+        try:
+            cursor.execute('SELECT MAX(seq) FROM snippets;')
+            max_seq = cursor.fetchone()
+        except (MySQLdb.OperationalError, MySQLdb.ProgrammingError):
+            # The database was installed before snippets had a seq column.
+            max_seq = None
+    if max_seq is None or max_seq[0] is None:
+        # Either there's no seq column or it wasn't populated yet, so fall
+        # back to a slower, less uniform pick. For small datasets, the
+        # probability of getting an empty set here is high, so retry.
+        with log_time('select without category by rand'):
+            for retry in range(1000):
+                cursor.execute(
+                    'SELECT id FROM snippets WHERE RAND() < 1e-4 LIMIT 1;')
+                ret = _fetch_id(cursor)
+                if ret is not None:
+                    return ret
+        return None
+    with log_time('select without category'):
+        cursor.execute('SELECT id FROM snippets WHERE seq = %s;',
+            (random.randint(0, max_seq[0]),))
+        return _fetch_id(cursor)
+
+def _query_next_id_by_ordinal(lang_code, curr_id, group_id,
+        ordinals_table, count_table, group_column):
+    # The next snippet is the one after the current one in the sequence of
+    # the category or intersection, wrapping around at the end.
+    cursor = get_db(lang_code).cursor()
+    with log_time('select next id by ordinal'):
+        cursor.execute('''
+            SELECT next.snippet_id
+            FROM {ordinals} AS curr, {counts} AS total, {ordinals} AS next
+            WHERE curr.{group} = %s AND curr.snippet_id = %s
+            AND total.{group} = curr.{group} AND next.{group} = curr.{group}
+            AND next.ordinal = (curr.ordinal + 1) MOD total.snippet_count
+            LIMIT 1'''.format(ordinals = ordinals_table,
+                counts = count_table, group = group_column),
+            (chdb.encode_id(group_id), chdb.encode_id(curr_id)))
+        return _fetch_id(cursor)
 
 def query_next_id_in_category(lang_code, curr_id, cat_id):
+    if _global_config.snippet_navigation == 'ordinals':
+        try:
+            return _query_next_id_by_ordinal(lang_code, curr_id, cat_id,
+                'categories_snippets', 'category_snippet_count',
+                'category_id')
+        except MySQLdb.ProgrammingError:
+            # The database was installed before we had the ordinals tables,
+            # but it does have the links.
+            pass
     cursor = get_db(lang_code).cursor()
     with log_time('select next id'):
         cursor.execute('''
             SELECT next FROM snippets_links WHERE prev = %s
-            AND cat_id = %s''', (curr_id, cat_id))
-        return cursor.fetchone()
+            AND cat_id = %s''',
+            (chdb.encode_id(curr_id), chdb.encode_id(cat_id)))
+        return _fetch_id(cursor)
 
 def query_next_id_in_intersection(lang_code, curr_id, inter_id):
+    if _global_config.snippet_navigation == 'ordinals':
+        try:
+            return _query_next_id_by_ordinal(lang_code, curr_id, inter_id,
+                'intersections_snippets', 'intersection_snippet_count',
+                'inter_id')
+        except MySQLdb.ProgrammingError:
+            pass
     cursor = get_db(lang_code).cursor()
     with log_time('select next id'):
         cursor.execute('''
             SELECT next FROM snippets_links WHERE prev = %s
-            AND inter_id = %s''', (curr_id, inter_id))
-        return cursor.fetchone()
+            AND inter_id = %s''',
+            (chdb.encode_id(curr_id), chdb.encode_id(inter_id)))
+        return _fetch_id(cursor)
 
 def search_category(lang_code, needle, max_results):
     cursor = get_db(lang_code).cursor()
@@ -78,15 +210,19 @@ def search_category(lang_code, needle, max_results):
             AND category_article_count.category_id = categories.id
             LIMIT %s''', (needle, max_results))
     return [{
-        'id': row[0], 'title': row[1], 'npages': row[2]
+        'id': chdb.decode_id(row[0]), 'title': row[1], 'npages': row[2]
     } for row in cursor]
 
 def search_article_title(lang_code, needle, max_results):
     cursor = get_db(lang_code).cursor()
     needle = '%' + needle + '%'
+    snippet_id = 'snippets.id'
+    if _global_config.compact_ids:
+        snippet_id = 'LOWER(HEX(snippets.id))'
     with log_time('search title & snippets'):
         cursor.execute('''
-            SELECT articles.page_id, articles.title, GROUP_CONCAT(snippets.id)
+            SELECT articles.page_id, articles.title,
+            GROUP_CONCAT(''' + snippet_id + ''')
             FROM articles, snippets
             WHERE articles.title LIKE %s
             AND snippets.article_id = articles.page_id
@@ -127,34 +263,120 @@ def query_rev_users(lang_code, rev_ids):
             'WHERE NOT ISNULL(actor_user) AND rev_id IN %s', (tuple(rev_ids),))
         return [row[0].decode('utf-8') for row in cursor.fetchall()]
 
+def populate_snippets_seq(cursor):
+    # Number the snippets 0..n-1, which we can't do while inserting them
+    # since they come from multiple processes and some get deleted or
+    # ignored as duplicates.
+    cursor.execute('UPDATE snippets SET seq = NULL')
+    cursor.execute('SET @seq := -1')
+    cursor.execute('UPDATE snippets SET seq = (@seq := @seq + 1) ORDER BY id')
+
 def populate_snippets_links(cursor,
         intersection_ids = None, category_ids = None):
+    # The ids are passed in the format of our tables, as they usually come
+    # straight from them (see chdb.encode_id).
     assert bool(intersection_ids) ^ bool(category_ids), \
         'Can only pass one of intersection_ids and category_ids!'
     if intersection_ids:
-        cursor.execute('''
-            SELECT articles_intersections.inter_id, snippets.id
+        intersection_ids = tuple(intersection_ids)
+        ordinals_table = 'intersections_snippets'
+        count_table = 'intersection_snippet_count'
+        try:
+            # Intersections can be re-created, so start their sequences over.
+            cursor.execute(
+                'DELETE FROM intersections_snippets WHERE inter_id IN %s',
+                (intersection_ids,))
+            cursor.execute(
+                'DELETE FROM intersection_snippet_count WHERE inter_id IN %s',
+                (intersection_ids,))
+        except MySQLdb.ProgrammingError:
+            # The live database was installed before we had the ordinals
+            # tables, so only build the links, which is all it can use.
+            ordinals_table = count_table = None
+        snippets_query = '''
+            SELECT articles_intersections.inter_id AS group_id,
+            snippets.id AS snippet_id, articles.title AS title
             FROM snippets, articles_intersections, articles
             WHERE snippets.article_id = articles_intersections.article_id AND
             articles.page_id = articles_intersections.article_id AND
-            articles_intersections.inter_id IN %s
-            ORDER BY articles_intersections.inter_id, articles.title;''',
-            (tuple(intersection_ids),))
-        insert_tuple = '(%s, %s, NULL, %s)'
+            articles_intersections.inter_id IN %s'''
+        args = (intersection_ids,)
+        link_column = 'inter_id'
+        # Concurrent requests may be creating the same intersection, and
+        # their rows would collide after the DELETEs above. They compute the
+        # same ordinals and counts, so just let the last one win.
+        insert = 'REPLACE'
     else:
-        cursor.execute('''
-            SELECT articles_categories.category_id, snippets.id
+        category_ids = tuple(category_ids)
+        snippets_query = '''
+            SELECT articles_categories.category_id AS group_id,
+            snippets.id AS snippet_id, articles.title AS title
             FROM snippets, articles_categories, articles
             WHERE snippets.article_id = articles_categories.article_id AND
             articles.page_id = articles_categories.article_id AND
-            articles_categories.category_id IN %s
-            ORDER BY articles_categories.category_id, articles.title;''',
-            (tuple(category_ids),))
-        insert_tuple = '(%s, %s, %s, NULL)'
-    cursor.executemany('INSERT INTO snippets_links VALUES ' + insert_tuple,
-        ((p, n, id)
-        for id, group in it.groupby(cursor, lambda id_sid: id_sid[0])
-        for p, n in pair_with_next(snippet_id for (_, snippet_id) in group)))
+            articles_categories.category_id IN %s'''
+        args = (category_ids,)
+        link_column = 'cat_id'
+        ordinals_table = 'categories_snippets'
+        count_table = 'category_snippet_count'
+        insert = 'INSERT'
+
+    # With ordinals navigation, the next snippet is computed from the
+    # ordinals (see _query_next_id_by_ordinal), so we don't need the links.
+    build_links = (_global_config.snippet_navigation == 'links' or
+        ordinals_table is None)
+    if chdb.supports_window_functions(cursor):
+        _populate_snippets_links_in_db(cursor, snippets_query, args,
+            link_column, ordinals_table, count_table, build_links, insert)
+        return
+
+    cursor.execute(
+        snippets_query + ' ORDER BY group_id, title, snippet_id', args)
+    # The rows come ordered by category or intersection, so sorting each
+    # group's links by prev makes us insert them in the order of the
+    # (cat_id/inter_id, prev, next) indexes rather than all over them.
+    links, ordinals, counts = [], [], []
+    for id, group in it.groupby(cursor.fetchall(), lambda row: row[0]):
+        snippet_ids = [snippet_id for (_, snippet_id, _) in group]
+        if build_links:
+            links.extend(
+                (p, n, id) for p, n in sorted(pair_with_next(snippet_ids)))
+        ordinals.extend(
+            (id, ordinal, snippet_id)
+            for ordinal, snippet_id in enumerate(snippet_ids))
+        counts.append((id, len(snippet_ids)))
+    if links:
+        cursor.executemany('''
+            INSERT INTO snippets_links (prev, next, ''' + link_column + ''')
+            VALUES (%s, %s, %s)''', links)
+    if ordinals_table is not None:
+        cursor.executemany(insert + ' INTO ' + ordinals_table +
+            ' VALUES (%s, %s, %s)', ordinals)
+        cursor.executemany(
+            insert + ' INTO ' + count_table + ' VALUES (%s, %s)', counts)
+
+def _populate_snippets_links_in_db(cursor, snippets_query, args,
+        link_column, ordinals_table, count_table, build_links, insert):
+    # Same as the loop in populate_snippets_links, but using window functions
+    # so the snippet ids never leave the database. Each snippet links to the
+    # next one in its group, and the last one wraps around to the first.
+    window = 'OVER (PARTITION BY group_id ORDER BY title, snippet_id)'
+    if build_links:
+        cursor.execute('''
+            INSERT INTO snippets_links (prev, next, ''' + link_column + ''')
+            SELECT snippet_id, COALESCE(
+                LEAD(snippet_id) ''' + window + ''',
+                FIRST_VALUE(snippet_id) ''' + window + '''), group_id
+            FROM (''' + snippets_query + ''') AS s
+            ORDER BY group_id, snippet_id''', args)
+    if ordinals_table is None:
+        return
+    cursor.execute(insert + ' INTO ' + ordinals_table + '''
+        SELECT group_id, ROW_NUMBER() ''' + window + ''' - 1, snippet_id
+        FROM (''' + snippets_query + ''') AS s''', args)
+    cursor.execute(insert + ' INTO ' + count_table + '''
+        SELECT group_id, COUNT(*) FROM (''' + snippets_query + ''') AS s
+        GROUP BY group_id''', args)
 
 def create_intersection(lang_code, page_ids, max_pages, expiration_days):
     db = get_db(lang_code)
@@ -171,6 +393,7 @@ def create_intersection(lang_code, page_ids, max_pages, expiration_days):
     page_ids = [row[0] for row in intersection]
     titles = [row[1] for row in intersection]
     inter_id = mkid('|'.join(title.lower() for title in sorted(titles)))
+    db_inter_id = chdb.encode_id(inter_id)
 
     def insert_intersection(cursor):
         with chdb.ignore_warnings():
@@ -180,16 +403,16 @@ def create_intersection(lang_code, page_ids, max_pages, expiration_days):
             # INSERT IGNORE/UPDATE but that's a MySQL extension.
             cursor.execute('''
                 INSERT IGNORE INTO intersections VALUES (%s, 0)
-            ''', (inter_id,))
+            ''', (db_inter_id,))
             cursor.execute('''
                 UPDATE intersections
                 SET expiration = DATE_ADD(NOW(), INTERVAL %s DAY)
                 WHERE id = %s
-            ''', (expiration_days, inter_id))
+            ''', (expiration_days, db_inter_id))
             cursor.executemany('''
                 INSERT IGNORE INTO articles_intersections VALUES (%s, %s)
-            ''', [(page_id, inter_id) for page_id in page_ids])
-            populate_snippets_links(cursor, intersection_ids = [inter_id])
+            ''', [(page_id, db_inter_id) for page_id in page_ids])
+            populate_snippets_links(cursor, intersection_ids = [db_inter_id])
         return inter_id, page_ids
     return db.execute_with_retry(insert_intersection)
 
@@ -204,6 +427,6 @@ def get_snippets_in_articles(lang_code, page_ids, max_snippets):
         LIMIT %s''', tuple(page_ids), max_snippets)
     if rows is None:
         return {}
-    return {title: [r[1] for r in rows]
+    return {title: [chdb.decode_id(r[1]) for r in rows]
             for title, rows in itertools.groupby(
                 rows, key = lambda r: r[0])}
@@ -0,0 +1,154 @@
+import os
+import sys
+_upper_dir = os.path.abspath(
+    os.path.join(os.path.dirname(__file__), '..'))
+if _upper_dir not in sys.path:
+    sys.path.append(_upper_dir)
+
+from . import database
+import chdb
+
+import flask
+import mock
+import MySQLdb
+
+import time
+import unittest
+
+class FakeCursor(object):
+    '''
+    A cursor whose statements fail with ProgrammingError if they mention any
+    of `missing_tables`, and otherwise return the rows in `results` in order.
+    '''
+
+    def __init__(self, missing_tables = (), results = ()):
+        self.missing_tables = missing_tables
+        self.results = list(results)
+        self.statements = []
+
+    def execute(self, sql, args = None):
+        if any(table in sql for table in self.missing_tables):
+            raise MySQLdb.ProgrammingError(1146, 'Table doesn\'t exist')
+        self.statements.append(sql)
+
+    def executemany(self, sql, args):
+        self.execute(sql, args)
+
+    def fetchone(self):
+        return self.results.pop(0) if self.results else None
+
+    def fetchall(self):
+        results, self.results = self.results, []
+        return results
+
+class DatabaseTestCase(unittest.TestCase):
+    def setUp(self):
+        self.cursor = FakeCursor()
+        self.db = mock.Mock()
+        self.db.cursor.return_value = self.cursor
+        app_context = flask.Flask(__name__).app_context()
+        app_context.push()
+        self.addCleanup(app_context.pop)
+        patcher = mock.patch.object(database, 'get_db', return_value = self.db)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+class MissingOrdinalsTablesTest(DatabaseTestCase):
+    def setUp(self):
+        super(MissingOrdinalsTablesTest, self).setUp()
+        self.cursor.missing_tables = (
+            'categories_snippets', 'category_snippet_count',
+            'intersections_snippets', 'intersection_snippet_count')
+
+    def test_snippet_by_category_falls_back_to_rand(self):
+        self.cursor.results = [('93b6f3cf',)]
+        self.assertEqual(
+            database.query_snippet_by_category('en', 'b5e1a25d'),
+            ('93b6f3cf',))
+        self.assertIn('ORDER BY RAND()', self.cursor.statements[-1])
+        self.assertIn('articles_categories', self.cursor.statements[-1])
+
+    def test_snippet_by_intersection_falls_back_to_rand(self):
+        self.cursor.results = [('93b6f3cf',)]
+        self.assertEqual(
+            database.query_snippet_by_intersection('en', 'c4a1e27d'),
+            ('93b6f3cf',))
+        self.assertIn('ORDER BY RAND()', self.cursor.statements[-1])
+        self.assertIn('articles_intersections', self.cursor.statements[-1])
+
+    def test_next_id_by_ordinal_falls_back_to_links(self):
+        self.cursor.results = [('93b6f3cf',)]
+        with mock.patch.object(database._global_config,
+                'snippet_navigation', 'ordinals'):
+            self.assertEqual(database.query_next_id_in_intersection(
+                'en', '3f3c6b39', 'c4a1e27d'), ('93b6f3cf',))
+        self.assertIn('snippets_links', self.cursor.statements[-1])
+
+    def test_populate_intersection_only_builds_links(self):
+        self.cursor.results = [
+            ('inter', 'snippet1', 'A'), ('inter', 'snippet2', 'B')]
+        for window_functions in (False, True):
+            self.cursor.statements = []
+            with mock.patch.object(database._global_config,
+                    'snippet_navigation', 'ordinals'), \
+                    mock.patch.object(chdb, '_window_functions_supported',
+                        window_functions):
+                database.populate_snippets_links(
+                    self.cursor, intersection_ids = ['inter'])
+            self.assertTrue(any('INTO snippets_links' in sql
+                for sql in self.cursor.statements))
+
+class SnippetCacheTest(DatabaseTestCase):
+    def setUp(self):
+        super(SnippetCacheTest, self).setUp()
+        self.snippet = ('Some snippet', 'Some section',
+            'https://en.wikipedia.org/wiki/A', 'A', None)
+        self.clock = mock.patch('time.time', return_value = 1000.)
+        self.clock.start()
+        self.addCleanup(self.clock.stop)
+        database._snippet_cache.clear()
+        database._generations.clear()
+        self.addCleanup(database._snippet_cache.clear)
+        self.addCleanup(database._generations.clear)
+
+    def query_snippet(self, generation):
+        self.cursor.results = [(generation,), self.snippet]
+        return database.query_snippet_by_id('en', '93b6f3cf')
+
+    def snippet_queries(self):
+        return [sql for sql in self.cursor.statements
+            if 'FROM snippets, articles' in sql]
+
+    def test_miss_then_hit(self):
+        misses = database._snippet_cache.misses
+        self.assertEqual(self.query_snippet('gen1'), self.snippet)
+        self.assertEqual(database._snippet_cache.misses, misses + 1)
+        hits = database._snippet_cache.hits
+        self.assertEqual(self.query_snippet('gen1'), self.snippet)
+        self.assertEqual(database._snippet_cache.hits, hits + 1)
+        self.assertEqual(len(self.snippet_queries()), 1)
+
+    def test_generation_is_checked_periodically(self):
+        self.query_snippet('gen1')
+        self.query_snippet('gen2')
+        generation_queries = [sql for sql in self.cursor.statements
+            if 'FROM generation' in sql]
+        self.assertEqual(len(generation_queries), 1)
+
+    def test_new_generation_invalidates_cache(self):
+        self.query_snippet('gen1')
+        time.time.return_value += (
+            database._global_config.snippet_cache_generation_check_s)
+        self.assertEqual(self.query_snippet('gen2'), self.snippet)
+        self.assertEqual(len(self.snippet_queries()), 2)
+
+    def test_missing_snippet_is_not_cached(self):
+        self.cursor.results = [('gen1',)]
+        self.assertIsNone(database.query_snippet_by_id('en', '93b6f3cf'))
+        self.cursor.results = [self.snippet]
+        self.assertEqual(
+            database.query_snippet_by_id('en', '93b6f3cf'), self.snippet)
+        self.assertEqual(len(self.snippet_queries()), 2)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -30,6 +30,9 @@ def validate_request_json(request):
             raise TypeError
 
 def intersect_with_page_titles(cfg, page_titles):
+    # The config we're given is shared across requests, so get our own copy
+    # to use the Wikipedia API with.
+    cfg = config.get_localized_config(cfg.lang_code)
     cfg.enable_wikipedia_api()
     page_ids = []
     for chunk in ichunk(page_titles, PAGE_TITLES_PER_API_REQUEST):
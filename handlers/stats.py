@@ -4,33 +4,204 @@ import chdb
 import utils
 from .common import *
 
+import atexit
 import datetime
+import functools
 import os
 import json
+import queue
 import re
-import itertools
-
-crawler_user_agents_regexps = [
-    re.compile(obj['pattern'], re.IGNORECASE)
-    for obj in json.load(
-        open(os.path.join(os.path.dirname(__file__),
-            'crawler-user-agents', 'crawler-user-agents.json')))
-]
-
-referrer_spam_regexps = [
-    re.compile(domain.strip(), re.IGNORECASE)
-    for domain in open(
-        os.path.join(os.path.dirname(__file__),
-            'referrer-spam-blacklist', 'spammers.txt'))
-]
+import threading
+import time
 
+# Characters that make a referrer spam entry more than a plain domain name.
+# Dots are allowed, but note that, as in the original regexps, they still
+# match any character.
+_REGEXP_METACHARACTERS = set('\\[](){}*+?|^$')
+
+def _literal_trie_regexp(patterns):
+    '''
+    Given patterns consisting of literal characters and '.', returns a regexp
+    equivalent to their alternation, but with shared prefixes factored out
+    (e.g. 'abc|abd' becomes 'ab(?:c|d)') so searching for it only tries the
+    alternatives whose prefix matches.
+    '''
+
+    trie = {}
+    for pattern in patterns:
+        node = trie
+        for c in pattern.lower():
+            node = node.setdefault(c, {})
+        # We only care whether anything matches, so a pattern that is a
+        # prefix of others makes the longer ones redundant.
+        node.clear()
+        node[''] = True
+
+    def to_regexp(node):
+        if '' in node:
+            return ''
+        alternatives = [
+            (c if c == '.' else re.escape(c)) + to_regexp(child)
+            for c, child in sorted(node.items())]
+        if len(alternatives) == 1:
+            return alternatives[0]
+        return '(?:' + '|'.join(alternatives) + ')'
+    return to_regexp(trie)
+
+def _compile_spam_regexp(patterns):
+    # Don't let an empty line match everything.
+    patterns = [p for p in patterns if p]
+    literal = [p for p in patterns if not _REGEXP_METACHARACTERS & set(p)]
+    other = [p for p in patterns if _REGEXP_METACHARACTERS & set(p)]
+    alternatives = ['(?:%s)' % p for p in other]
+    if literal:
+        alternatives.append(_literal_trie_regexp(literal))
+    if not alternatives:
+        # Never matches.
+        return re.compile('(?!)')
+    return re.compile('|'.join(alternatives), re.IGNORECASE)
+
+def _load_crawler_user_agent_patterns():
+    with open(os.path.join(os.path.dirname(__file__),
+            'crawler-user-agents', 'crawler-user-agents.json')) as f:
+        return [obj['pattern'] for obj in json.load(f)]
+
+def _load_referrer_spam_patterns():
+    with open(os.path.join(os.path.dirname(__file__),
+            'referrer-spam-blacklist', 'spammers.txt')) as f:
+        return [domain.strip() for domain in f]
+
+# A single regexp for each list, so that is_spam does one search per string
+# rather than one per entry.
+crawler_user_agents_regexp = _compile_spam_regexp(
+    _load_crawler_user_agent_patterns())
+referrer_spam_regexp = _compile_spam_regexp(_load_referrer_spam_patterns())
+
+# Most requests come from a small set of browsers and referrers.
+@functools.lru_cache(maxsize = 4096)
 def is_spam(user_agent, referrer):
     # Normalize None to the empty string
     user_agent = user_agent or ''
     referrer = referrer or ''
-    return any(itertools.chain(
-        (r.search(user_agent) for r in crawler_user_agents_regexps),
-        (r.search(referrer) for r in referrer_spam_regexps)))
+    return bool(crawler_user_agents_regexp.search(user_agent) or
+        referrer_spam_regexp.search(referrer))
+
+class RequestLogWriter(object):
+    '''
+    Inserts rows into the requests table from a background thread, in
+    batches of up to `batch_size` rows written at least every
+    `flush_interval_s` seconds.
+
+    At most `max_queue_size` rows wait to be written, and rows logged past
+    that are dropped and counted in `dropped`.
+
+    The first column of each row is the time.time() at which the request was
+    logged. It is written as an offset from the database's NOW(), like the
+    rest of the timestamps in the stats database, rather than as the web
+    server's local time.
+    '''
+
+    _STOP = object()
+
+    def __init__(self, connect, logger, batch_size, flush_interval_s,
+            max_queue_size):
+        self._connect = connect
+        self._logger = logger
+        self._batch_size = batch_size
+        self._flush_interval_s = flush_interval_s
+        self._queue = queue.Queue(max_queue_size)
+        self._thread = None
+        self._lock = threading.Lock()
+        self.dropped = 0
+
+    def log(self, row):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target = self._run, name = 'RequestLogWriter',
+                    daemon = True)
+                self._thread.start()
+        try:
+            self._queue.put_nowait(row)
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+                if self.dropped % 1000 == 1:
+                    self._logger.warning(
+                        'request log queue is full, %d rows dropped so far',
+                        self.dropped)
+
+    def close(self, timeout_s = 10):
+        '''Write out the queued rows and stop the background thread.'''
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is None:
+            return
+        try:
+            self._queue.put(self._STOP, timeout = timeout_s)
+        except queue.Full:
+            return
+        thread.join(timeout_s)
+
+    def _run(self):
+        db = None
+        stopping = False
+        while not stopping:
+            batch = []
+            deadline = None
+            while len(batch) < self._batch_size:
+                timeout = None
+                if deadline is not None:
+                    timeout = deadline - time.time()
+                    if timeout <= 0:
+                        break
+                try:
+                    row = self._queue.get(timeout = timeout)
+                except queue.Empty:
+                    break
+                if row is self._STOP:
+                    stopping = True
+                    break
+                batch.append(row)
+                if deadline is None:
+                    deadline = time.time() + self._flush_interval_s
+            if not batch:
+                continue
+            try:
+                if db is None:
+                    db = self._connect()
+                db.execute_with_retry(self._insert, batch)
+            except Exception:
+                self._logger.exception(
+                    'failed to write %d request log rows', len(batch))
+                with self._lock:
+                    self.dropped += len(batch)
+                db = None
+
+    def _insert(self, cursor, batch):
+        now = time.time()
+        batch = [(max(0, int(round(now - row[0]))),) + tuple(row[1:])
+            for row in batch]
+        with chdb.ignore_warnings():
+            cursor.executemany('INSERT INTO requests VALUES '
+                '(NOW() - INTERVAL %s SECOND, '
+                '%s, %s, %s, %s, %s, %s, %s, %s)', batch)
+
+_request_log_writer = None
+_request_log_writer_lock = threading.Lock()
+
+def get_request_log_writer():
+    global _request_log_writer
+    with _request_log_writer_lock:
+        if _request_log_writer is None:
+            cfg = config.get_global_config()
+            _request_log_writer = RequestLogWriter(
+                chdb.init_stats_db, flask.current_app.logger,
+                cfg.stats_log_batch_size,
+                cfg.stats_log_flush_interval_ms / 1000.,
+                cfg.stats_log_queue_size)
+            atexit.register(_request_log_writer.close)
+        return _request_log_writer
 
 def log_request(response):
     user_agent = flask.request.headers.get('User-Agent', None)
@@ -48,11 +219,9 @@ def log_request(response):
                 flask.request.headers.get('X-Moz') == 'prefetch')
     status_code = response.status_code
 
-    with get_stats_db().cursor() as cursor, chdb.ignore_warnings():
-        cursor.execute('INSERT INTO requests VALUES '
-            '(NOW(), %s, %s, %s, %s, %s, %s, %s, %s)',
-            (lang_code, id, cat, url, prefetch, status_code, referrer,
-             inter_id))
+    get_request_log_writer().log(
+        (time.time(), lang_code, id, cat, url, prefetch,
+         status_code, referrer, inter_id))
     return response
 
 def pad(data, days, default = 0):
@@ -147,7 +316,8 @@ def stats(lang_code):
     ch_cursor = get_db(lang_code).cursor()
     for category_id, count in stats_cursor:
         ch_cursor.execute(
-            'SELECT title FROM categories WHERE id = %s', (category_id,))
+            'SELECT title FROM categories WHERE id = %s',
+            (chdb.encode_id(category_id),))
         title = list(ch_cursor)[0][0] if ch_cursor.rowcount else "(gone)"
         data_rows.append((title, count))
     graphs.append((
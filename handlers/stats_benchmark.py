@@ -0,0 +1,117 @@
+'''
+Micro-benchmark for is_spam, comparing it against searching for each
+crawler and referrer spam regexp separately.
+
+Usage:
+    python -m handlers.stats_benchmark
+'''
+
+import os
+import sys
+_upper_dir = os.path.abspath(
+    os.path.join(os.path.dirname(__file__), '..'))
+if _upper_dir not in sys.path:
+    sys.path.append(_upper_dir)
+
+import importlib
+import itertools
+import json
+import re
+import timeit
+
+# Not `from . import stats`, which is shadowed by the stats() handler.
+stats = importlib.import_module('.stats', __package__)
+
+# Real browser user agents, which make up most of our traffic and must not
+# be flagged as spam.
+BROWSER_USER_AGENTS = [
+    'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 '
+        '(KHTML, like Gecko) Chrome/118.0.0.0 Safari/537.36',
+    'Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:109.0) Gecko/20100101 '
+        'Firefox/118.0',
+    'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15 '
+        '(KHTML, like Gecko) Version/17.0 Safari/605.1.15',
+    'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) '
+        'Chrome/117.0.0.0 Safari/537.36',
+    'Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:109.0) Gecko/20100101 '
+        'Firefox/115.0',
+    'Mozilla/5.0 (iPhone; CPU iPhone OS 17_0 like Mac OS X) '
+        'AppleWebKit/605.1.15 (KHTML, like Gecko) Version/17.0 '
+        'Mobile/15E148 Safari/604.1',
+    'Mozilla/5.0 (Linux; Android 10; K) AppleWebKit/537.36 (KHTML, like '
+        'Gecko) Chrome/118.0.0.0 Mobile Safari/537.36',
+    'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, '
+        'like Gecko) Chrome/118.0.0.0 Safari/537.36 Edg/118.0.2088.46',
+    'Mozilla/5.0 (iPad; CPU OS 16_6 like Mac OS X) AppleWebKit/605.1.15 '
+        '(KHTML, like Gecko) CriOS/118.0.5993.69 Mobile/15E148 Safari/604.1',
+    'Mozilla/5.0 (Linux; Android 13; SM-S908B) AppleWebKit/537.36 (KHTML, '
+        'like Gecko) SamsungBrowser/22.0 Chrome/111.0.5563.116 Mobile '
+        'Safari/537.36',
+]
+
+REFERRERS = [
+    None,
+    'https://en.wikipedia.org/wiki/Main_Page',
+    'https://citationhunt.toolforge.org/en?id=93b6f3cf',
+    'https://www.google.com/',
+    'https://duckduckgo.com/?q=citation+hunt',
+    'https://meta.wikimedia.org/wiki/Citation_Hunt',
+]
+
+def crawler_user_agents():
+    '''The example user agents that come with crawler-user-agents.json.'''
+    with open(os.path.join(os.path.dirname(__file__),
+            'crawler-user-agents', 'crawler-user-agents.json')) as f:
+        return [i for obj in json.load(f) for i in obj.get('instances', [])]
+
+def spam_referrers():
+    return ['http://' + p + '/'
+        for p in stats._load_referrer_spam_patterns()[::10]]
+
+def make_corpus():
+    user_agents = BROWSER_USER_AGENTS + crawler_user_agents()
+    referrers = REFERRERS + spam_referrers()
+    return list(itertools.product(user_agents, referrers))
+
+class NaiveSpamDetector(object):
+    '''Searches for each regexp in turn, as is_spam used to.'''
+
+    def __init__(self):
+        self._user_agent_regexps = [re.compile(p, re.IGNORECASE)
+            for p in stats._load_crawler_user_agent_patterns()]
+        self._referrer_regexps = [re.compile(p, re.IGNORECASE)
+            for p in stats._load_referrer_spam_patterns()]
+
+    def is_spam(self, user_agent, referrer):
+        user_agent = user_agent or ''
+        referrer = referrer or ''
+        return any(itertools.chain(
+            (r.search(user_agent) for r in self._user_agent_regexps),
+            (r.search(referrer) for r in self._referrer_regexps)))
+
+def _time_per_call(fn, corpus, repeat = 5):
+    def run():
+        for user_agent, referrer in corpus:
+            fn(user_agent, referrer)
+    return min(timeit.repeat(run, number = 1, repeat = repeat)) / len(corpus)
+
+if __name__ == '__main__':
+    corpus = make_corpus()
+    naive = NaiveSpamDetector().is_spam
+    uncached = stats.is_spam.__wrapped__
+    # Most real traffic isn't spam, and that's where the naive detector is
+    # slowest since it has to try every regexp.
+    not_spam = [p for p in corpus if not naive(*p)]
+    for name, pairs in [('all pairs', corpus), ('non-spam pairs', not_spam)]:
+        print('%s: %d (user agent, referrer) pairs' % (name, len(pairs)))
+        results = [
+            ('one regexp per entry', _time_per_call(naive, pairs)),
+            ('combined regexps', _time_per_call(uncached, pairs)),
+            # Every pair repeats across runs, so these are all cache hits.
+            ('combined regexps + LRU cache',
+                _time_per_call(stats.is_spam, pairs)),
+        ]
+        baseline = results[0][1]
+        for name, t in results:
+            print('  %-30s %8.2f us/call %7.1fx' % (
+                name, t * 1e6, baseline / t))
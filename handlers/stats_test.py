@@ -0,0 +1,102 @@
+import os
+import sys
+_upper_dir = os.path.abspath(
+    os.path.join(os.path.dirname(__file__), '..'))
+if _upper_dir not in sys.path:
+    sys.path.append(_upper_dir)
+
+# Not `from . import stats`, which is shadowed by the stats() handler.
+from .stats import RequestLogWriter, is_spam, _compile_spam_regexp
+from . import stats_benchmark
+
+import mock
+
+import queue
+import unittest
+
+class IsSpamTest(unittest.TestCase):
+    def test_same_results_as_naive_detector(self):
+        naive = stats_benchmark.NaiveSpamDetector()
+        corpus = stats_benchmark.make_corpus()
+        self.assertTrue(any(naive.is_spam(*p) for p in corpus))
+        self.assertFalse(all(naive.is_spam(*p) for p in corpus))
+        for user_agent, referrer in corpus:
+            self.assertEqual(
+                naive.is_spam(user_agent, referrer),
+                is_spam(user_agent, referrer), (user_agent, referrer))
+
+    def test_browsers_are_not_spam(self):
+        for user_agent in stats_benchmark.BROWSER_USER_AGENTS:
+            self.assertFalse(is_spam(user_agent, None), user_agent)
+
+    def test_literal_patterns(self):
+        regexp = _compile_spam_regexp(
+            ['spam.com', 'spam.co', 'Eggs.org', 'ham.net', ''])
+        self.assertTrue(regexp.search('http://spam.co.uk/'))
+        self.assertTrue(regexp.search('http://www.EGGS.org'))
+        # Dots match any character, like in the original regexps.
+        self.assertTrue(regexp.search('hamxnet'))
+        self.assertFalse(regexp.search('http://example.com'))
+        self.assertFalse(regexp.search(''))
+
+    def test_regexp_patterns(self):
+        regexp = _compile_spam_regexp(['^bot', 'crawl(er|ing)', 'spam.com'])
+        self.assertTrue(regexp.search('Bot/1.0'))
+        self.assertFalse(regexp.search('Mozilla bot'))
+        self.assertTrue(regexp.search('Crawling'))
+        self.assertTrue(regexp.search('spam.com'))
+
+class RequestLogWriterTest(unittest.TestCase):
+    def setUp(self):
+        self.batches = []
+        self.db = mock.Mock()
+        self.db.execute_with_retry.side_effect = (
+            lambda operations, batch: self.batches.append(list(batch)))
+
+    def make_writer(self, batch_size = 2, flush_interval_s = 60,
+            max_queue_size = 100):
+        return RequestLogWriter(lambda: self.db, mock.Mock(),
+            batch_size, flush_interval_s, max_queue_size)
+
+    def test_writes_full_batches(self):
+        writer = self.make_writer()
+        for i in range(5):
+            writer.log((i,))
+        writer.close()
+        self.assertEqual(self.batches, [[(0,), (1,)], [(2,), (3,)], [(4,)]])
+        self.assertEqual(writer.dropped, 0)
+
+    def test_writes_partial_batch_after_interval(self):
+        writer = self.make_writer(batch_size = 100, flush_interval_s = 0.01)
+        writer.log((0,))
+        writer._thread.join(0.5)  # Still running, but has written by now.
+        self.assertEqual(self.batches, [[(0,)]])
+        writer.close()
+
+    def test_drops_rows_when_queue_is_full(self):
+        writer = self.make_writer(max_queue_size = 1)
+        with mock.patch.object(writer, '_queue') as q:
+            q.put_nowait.side_effect = queue.Full
+            writer.log((0,))
+            writer.log((1,))
+        self.assertEqual(writer.dropped, 2)
+
+    def test_counts_failed_writes_as_dropped(self):
+        self.db.execute_with_retry.side_effect = Exception
+        writer = self.make_writer()
+        writer.log((0,))
+        writer.log((1,))
+        writer.close()
+        self.assertEqual(writer.dropped, 2)
+
+    def test_insert_uses_database_clock(self):
+        writer = self.make_writer()
+        cursor = mock.Mock()
+        with mock.patch('time.time', return_value = 1000.):
+            writer._insert(cursor, [(990., 'en', 'id'), (1000.2, 'en', None)])
+        sql, rows = cursor.executemany.call_args[0]
+        self.assertIn('NOW() - INTERVAL %s SECOND', sql)
+        self.assertEqual(rows, [(10, 'en', 'id'), (0, 'en', None)])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -4,7 +4,11 @@
 Assign categories to the pages in the CitationHunt database.
 
 Usage:
-    assign_categories.py
+    assign_categories.py [--streaming]
+
+Options:
+    --streaming    Group the pages by category in a table in the database
+                   rather than in memory.
 '''
 
 import os
@@ -19,15 +23,24 @@ import chdb as chdb_
 import handlers.database as database
 from utils import *
 
+import MySQLdb.cursors
 import docopt
 
 import cProfile
 import re
 import collections
+import concurrent.futures
+import functools
 import logging
 import pstats
 import time
 
+# Toolforge limits us to 20 connections per user
+# (https://phabricator.wikimedia.org/T216170), so leave a few for the scratch
+# database and the other connections we use no matter how many replica
+# connections we're configured to use.
+MAX_REPLICA_CONNECTIONS = 16
+
 logger = logging.getLogger('assign_categories')
 setup_logger_to_stderr(logger)
 
@@ -67,16 +80,16 @@ class CategoryName(str):
 
 def category_ids_to_names(wpcursor, category_ids):
     category_names = set()
-    for pageid in category_ids:
-        wpcursor.execute('''SELECT page_title FROM page WHERE page_id = %s''',
-            (pageid,))
+    for c in ichunk(category_ids, 10000):
+        wpcursor.execute('''
+            SELECT page_title FROM page WHERE page_id IN %s''', (tuple(c),))
         category_names.update(
             CategoryName.from_wp_page(row[0])
             for row in wpcursor)
     return category_names
 
 def category_name_to_id(catname):
-    return mkid(catname)
+    return chdb_.encode_id(mkid(catname))
 
 def load_unsourced_pageids(chdb):
     cursor = chdb.cursor()
@@ -99,6 +112,44 @@ def load_categories_for_pages(wpcursor, pageids):
     return ((CategoryName.from_wp_categorylinks(row[0]), row[1])
             for row in wpcursor)
 
+def load_categories_for_page_chunks(cfg, pageid_chunks):
+    '''
+    Yields a list of (category name, page id) pairs for each chunk of page ids
+    in `pageid_chunks`, in no particular order. The chunks are loaded
+    concurrently over up to cfg.assign_categories_replica_connections
+    connections to the replica.
+    '''
+    nconnections = max(1, min(
+        cfg.assign_categories_replica_connections, MAX_REPLICA_CONNECTIONS))
+    pool = chdb_.ConnectionPool(
+        lambda: chdb_.init_wp_replica_db(cfg.lang_code), nconnections,
+        max_idle_s = float('inf'), health_check_s = float('inf'))
+    def load(pageids):
+        wpdb = pool.get()
+        try:
+            return list(wpdb.execute_with_retry(
+                load_categories_for_pages, pageids))
+        finally:
+            pool.put(wpdb)
+
+    try:
+        with concurrent.futures.ThreadPoolExecutor(nconnections) as executor:
+            # Only keep as many chunks in flight as we have connections, so we
+            # don't hold on to more results than we need to.
+            pending = set()
+            for pageids in pageid_chunks:
+                pending.add(executor.submit(load, tuple(pageids)))
+                if len(pending) < nconnections:
+                    continue
+                done, pending = concurrent.futures.wait(
+                    pending, return_when = concurrent.futures.FIRST_COMPLETED)
+                for f in done:
+                    yield f.result()
+            for f in concurrent.futures.as_completed(pending):
+                yield f.result()
+    finally:
+        pool.close()
+
 def count_snippets_for_pages(chcursor):
     chcursor.execute(
         '''SELECT article_id, count(snippets.id) '''
@@ -111,16 +162,6 @@ def load_projectindex(cfg, toolsdb):
     # We use a special table on Tools Labs to map page IDs to projects,
     # which will hopefully be more broadly available soon
     # (https://phabricator.wikimedia.org/T131578)
-    pi_db = chdb_.get_en_projectindex_database_name()
-    ch_articles_tbl = chdb_.get_table_name(toolsdb, 'scratch', 'articles')
-    query = '''
-        SELECT project_title, index_page
-        FROM {pi_db}.enwiki_index
-        JOIN {pi_db}.enwiki_page ON index_page = page_id
-        JOIN {pi_db}.enwiki_project ON index_project = project_id
-        JOIN {ch_articles_tbl} ON index_page = {ch_articles_tbl}.page_id
-        WHERE page_ns = 0 AND page_is_redirect = 0
-    '''.format(pi_db=pi_db, ch_articles_tbl=ch_articles_tbl)
     def query_projectindex(cursor, query):
         cursor.execute(query)
         project_to_pageids = {}
@@ -128,10 +169,23 @@ def load_projectindex(cfg, toolsdb):
             project_to_pageids.setdefault(
                 CategoryName.from_tl_projectindex(r[0]), []).append(r[1])
         return project_to_pageids
-    ret = toolsdb.execute_with_retry(query_projectindex, query)
+    ret = toolsdb.execute_with_retry(
+        query_projectindex, projectindex_query(toolsdb))
     logger.info('loaded %d entries from projectinfo' % len(ret))
     return ret
 
+def projectindex_query(toolsdb):
+    pi_db = chdb_.get_en_projectindex_database_name()
+    ch_articles_tbl = chdb_.get_table_name(toolsdb, 'scratch', 'articles')
+    return '''
+        SELECT project_title, index_page
+        FROM {pi_db}.enwiki_index
+        JOIN {pi_db}.enwiki_page ON index_page = page_id
+        JOIN {pi_db}.enwiki_project ON index_project = project_id
+        JOIN {ch_articles_tbl} ON index_page = {ch_articles_tbl}.page_id
+        WHERE page_ns = 0 AND page_is_redirect = 0
+    '''.format(pi_db=pi_db, ch_articles_tbl=ch_articles_tbl)
+
 def category_is_usable(cfg, catname, hidden_categories):
     assert isinstance(catname, CategoryName)
     if catname in hidden_categories:
@@ -141,52 +195,140 @@ def category_is_usable(cfg, catname, hidden_categories):
             return False
     return True
 
+def make_category_filter(cfg, hidden_categories):
+    '''
+    Returns a function that tells whether a category is usable (see
+    category_is_usable), remembering the answers for the most common
+    categories since we see each one once per page it contains.
+    '''
+    @functools.lru_cache(maxsize = 100000)
+    def is_usable(catname):
+        return category_is_usable(cfg, catname, hidden_categories)
+    return is_usable
+
 def update_citationhunt_db(chdb, category_name_id_and_page_ids):
     def insert(cursor, chunk):
         cursor.executemany('''
             INSERT IGNORE INTO categories VALUES (%s, %s)
         ''', ((category_id, category_name)
             for category_name, category_id, _ in chunk))
+        # Sorted to match the (category_id, article_id) index.
         cursor.executemany('''
             INSERT INTO articles_categories VALUES (%s, %s)
-        ''', ((pageid, catid)
-            for _, catid, pageids in chunk for pageid in pageids))
+        ''', sorted(((pageid, catid)
+            for _, catid, pageids in chunk for pageid in pageids),
+            key = lambda pageid_catid: pageid_catid[::-1]))
         database.populate_snippets_links(cursor,
             category_ids = (cid for (_, cid, _) in chunk))
 
     for c in ichunk(category_name_id_and_page_ids, 4096):
         chdb.execute_with_retry(insert, list(c))
+    count_articles_in_categories(chdb)
 
+def count_articles_in_categories(chdb):
     chdb.execute_with_retry_s('''
         INSERT INTO category_article_count
         SELECT category_id, COUNT(*) AS article_count
         FROM articles_categories GROUP BY category_id''')
 
-def assign_categories():
-    cfg = config.get_localized_config()
-    profiler = cProfile.Profile()
-    if cfg.profile:
-        profiler.enable()
-    start = time.time()
-
-    chdb = chdb_.init_scratch_db()
-    wpdb = chdb_.init_wp_replica_db(cfg.lang_code)
+# The streaming mode (--streaming) collects the (category, page) pairs in this
+# table in the scratch database instead of in memory, then does the grouping
+# and filtering with queries against it.
+STAGING_TABLE = 'category_pages_staging'
+
+def create_staging_table(cursor):
+    cursor.execute('DROP TABLE IF EXISTS ' + STAGING_TABLE)
+    cursor.execute('''
+        CREATE TABLE {table} (category_id {id}, category_name VARCHAR(255),
+        page_id INT(8) UNSIGNED, PRIMARY KEY(category_id, page_id))
+        ENGINE=InnoDB DEFAULT CHARSET=utf8mb4
+    '''.format(table = STAGING_TABLE, id = chdb_.id_column_type()))
+
+def stage_category_pages(cursor, category_and_page_ids):
+    cursor.executemany('''
+        INSERT IGNORE INTO ''' + STAGING_TABLE + ''' VALUES (%s, %s, %s)
+    ''', sorted((category_name_to_id(category), str(category), pageid)
+        for category, pageid in category_and_page_ids))
+
+def iter_unsourced_pageids(chdb, chunk_size):
+    # Page through the articles by page id rather than loading them all.
+    last_pageid = -1
+    while True:
+        rows = chdb.execute_with_retry_s('''
+            SELECT page_id FROM articles WHERE page_id > %s
+            ORDER BY page_id LIMIT %s''', last_pageid, chunk_size)
+        if rows is None:
+            return
+        yield [r[0] for r in rows]
+        last_pageid = rows[-1][0]
+
+def stage_projectindex(cfg, toolsdb, stagingdb, chunk_size):
+    if not running_in_tools_labs() or cfg.lang_code != 'en':
+        return 0
+    def stream_projectindex(cursor, query):
+        # Use a server-side cursor so we only hold chunk_size rows at a time,
+        # and a separate connection to insert them while we read.
+        with cursor.connection.cursor(MySQLdb.cursors.SSCursor) as sscursor:
+            sscursor.execute(query)
+            nrows = 0
+            while True:
+                rows = sscursor.fetchmany(chunk_size)
+                if not rows:
+                    return nrows
+                stagingdb.execute_with_retry(stage_category_pages,
+                    [(CategoryName.from_tl_projectindex(r[0]), r[1])
+                    for r in rows])
+                nrows += len(rows)
+    ret = toolsdb.execute_with_retry(
+        stream_projectindex, projectindex_query(toolsdb))
+    logger.info('loaded %d entries from projectinfo' % ret)
+    return ret
 
+def update_citationhunt_db_from_staging(chdb):
+    # Keep only the categories with at least two snippets.
+    chdb.execute_with_retry_s('''
+        INSERT IGNORE INTO categories
+        SELECT category_id, MIN(category_name)
+        FROM {staging}, snippets WHERE snippets.article_id = page_id
+        GROUP BY category_id HAVING COUNT(*) >= 2
+    '''.format(staging = STAGING_TABLE))
+    chdb.execute_with_retry_s('''
+        INSERT INTO articles_categories
+        SELECT page_id, category_id FROM {staging}
+        WHERE category_id IN (SELECT id FROM categories)
+        ORDER BY category_id, page_id
+    '''.format(staging = STAGING_TABLE))
+    chdb.execute_with_retry_s('DROP TABLE ' + STAGING_TABLE)
+
+    # Build the links in chunks of categories, paging through them by id.
+    ncategories = 0
+    last_category_id = ''
+    while True:
+        rows = chdb.execute_with_retry_s('''
+            SELECT id FROM categories WHERE id > %s
+            ORDER BY id LIMIT 4096''', last_category_id)
+        if rows is None:
+            break
+        category_ids = [r[0] for r in rows]
+        chdb.execute_with_retry(
+            lambda cursor: database.populate_snippets_links(
+                cursor, category_ids = category_ids))
+        ncategories += len(category_ids)
+        last_category_id = category_ids[-1]
+    logger.info('finished with %d categories' % ncategories)
+    count_articles_in_categories(chdb)
+
+def assign_categories_in_memory(cfg, chdb, is_usable):
     unsourced_pageids = load_unsourced_pageids(chdb)
 
     # Load an initial {wikiproject -> [page ids]} dict, if applicable
     category_to_page_ids = load_projectindex(cfg, chdb)
 
-    # Load a set() of hidden categories
-    hidden_categories = wpdb.execute_with_retry(
-        load_hidden_categories, cfg)
-    logger.info('loaded %d hidden categories' % (len(hidden_categories),))
-
     # Load all usable categories and page ids
-    for c in ichunk(unsourced_pageids, 10000):
-        for c, p in wpdb.execute_with_retry(
-            load_categories_for_pages, tuple(c)):
-            if category_is_usable(cfg, c, hidden_categories):
+    for rows in load_categories_for_page_chunks(
+        cfg, ichunk(unsourced_pageids, 10000)):
+        for c, p in rows:
+            if is_usable(c):
                 category_to_page_ids.setdefault(c, []).append(p)
 
     # Now find out how many snippets each category has
@@ -206,6 +348,43 @@ def assign_categories():
         category_name_id_and_page_ids))
 
     update_citationhunt_db(chdb, category_name_id_and_page_ids)
+
+def assign_categories_streaming(cfg, chdb, is_usable):
+    chdb.execute_with_retry(create_staging_table)
+    # A second connection to the scratch database, for inserting into the
+    # staging table while streaming from the first one.
+    stagingdb = chdb_.init_scratch_db()
+    stage_projectindex(cfg, chdb, stagingdb, 10000)
+    stagingdb.close()
+
+    for rows in load_categories_for_page_chunks(
+        cfg, iter_unsourced_pageids(chdb, 10000)):
+        chdb.execute_with_retry(stage_category_pages,
+            [(c, p) for c, p in rows if is_usable(c)])
+
+    update_citationhunt_db_from_staging(chdb)
+
+def assign_categories(streaming):
+    cfg = config.get_localized_config()
+    profiler = cProfile.Profile()
+    if cfg.profile:
+        profiler.enable()
+    start = time.time()
+
+    chdb = chdb_.init_scratch_db()
+    wpdb = chdb_.init_wp_replica_db(cfg.lang_code)
+
+    # Load a set() of hidden categories
+    hidden_categories = wpdb.execute_with_retry(
+        load_hidden_categories, cfg)
+    logger.info('loaded %d hidden categories' % (len(hidden_categories),))
+
+    is_usable = make_category_filter(cfg, hidden_categories)
+
+    if streaming:
+        assign_categories_streaming(cfg, chdb, is_usable)
+    else:
+        assign_categories_in_memory(cfg, chdb, is_usable)
     wpdb.close()
     chdb.close()
     logger.info('all done in %d seconds.' % (time.time() - start))
@@ -218,5 +397,5 @@ def assign_categories():
 
 if __name__ == '__main__':
     args = docopt.docopt(__doc__)
-    ret = assign_categories()
+    ret = assign_categories(args['--streaming'])
     sys.exit(ret)
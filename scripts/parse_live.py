@@ -9,10 +9,13 @@ valid snippets in the `articles` database table, and the snippets in the
 `snippets` table.
 
 Usage:
-    parse_live.py <pageid-file> [--timeout=<n>]
+    parse_live.py <pageid-file> [--timeout=<n>] [--incremental]
 
 Options:
     --timeout=<n>    Maximum time in seconds to run for [default: inf].
+    --incremental    Only parse the pages that changed since they were parsed
+                     for the live database, and copy the snippets for the
+                     other pages from it.
 '''
 
 import os
@@ -25,15 +28,18 @@ if _upper_dir not in sys.path:
 
 import chdb
 import config
+import handlers.database as database
 import yamwapi as mwapi
 import snippet_parser
 from utils import *
 
 import docopt
 import requests
+import requests.adapters
 
+import asyncio
+import concurrent.futures
 import cProfile
-import functools
 import glob
 import itertools
 import logging
@@ -42,6 +48,7 @@ import pstats
 import re
 import shutil
 import tempfile
+import threading
 import time
 import traceback
 import types
@@ -53,7 +60,13 @@ cfg.enable_wikipedia_api()
 WIKIPEDIA_BASE_URL = 'https://' + cfg.wikipedia_domain
 WIKIPEDIA_WIKI_URL = WIKIPEDIA_BASE_URL + '/wiki/'
 
-MAX_EXCEPTIONS_PER_SUBPROCESS = 25
+# How many pageids to query the API for at a time
+PAGEIDS_BATCH_SIZE = 32
+
+# How many articles to insert into the database at a time
+INSERT_BATCH_SIZE = 32
+
+MAX_EXCEPTIONS = 250
 
 DATA_TRUNCATED_WARNING_RE = re.compile(
     'Data truncated for column .* at row (\d+)')
@@ -61,6 +74,9 @@ DATA_TRUNCATED_WARNING_RE = re.compile(
 logger = logging.getLogger('parse_live')
 setup_logger_to_stderr(logger)
 
+class TooManyExceptions(Exception):
+    pass
+
 def section_name_to_anchor(section):
     # See Sanitizer::escapeId
     # https://doc.wikimedia.org/mediawiki-core/master/php/html/classSanitizer.html#ae091dfff62f13c9c1e0d2e503b0cab49
@@ -76,141 +92,348 @@ def query_pageids(wiki, pageids):
     params = {
         'pageids': '|'.join(map(str, pageids)),
         'prop': 'revisions',
-        'rvprop': 'content',
+        'rvprop': 'content|ids',
         'rvslots': 'main'
     }
-    for response in self.wiki.query(params):
+    for response in wiki.query(params):
         for id, page in list(response['query']['pages'].items()):
             if 'title' not in page:
                 continue
             title = d(page['title'])
-            text = page['revisions'][0]['slots']['main']['*']
+            revision = page['revisions'][0]
+            text = revision['slots']['main']['*']
             if not text:
                 continue
             text = d(text)
-            yield (id, title, text)
+            yield (id, title, text, revision['revid'])
 
 self = types.SimpleNamespace() # Per-process state
 
 def initializer(backdir):
     self.backdir = backdir
 
-    self.wiki = cfg.wikipedia
-    self.parser = snippet_parser.create_snippet_parser(self.wiki, cfg)
-    self.exception_count = 0
+    # The worker processes only do the CPU-bound parts of parsing, all
+    # requests to the Wikipedia API are made by the main process.
+    self.parser = snippet_parser.create_snippet_parser(None, cfg)
 
     if cfg.profile:
         self.profiler = cProfile.Profile()
         self.profiler.enable()
-        # Undocumented :( https://stackoverflow.com/questions/24717468
-        multiprocessing.util.Finalize(None, finalizer, exitpriority=16)
+    # Undocumented :( https://stackoverflow.com/questions/24717468
+    multiprocessing.util.Finalize(None, finalizer, exitpriority=16)
 
 def finalizer():
-    self.profiler.disable()
-    profile_path = os.path.join(self.backdir, 'profile-%s' % os.getpid())
-    pstats.Stats(self.profiler).dump_stats(profile_path)
+    if cfg.profile:
+        self.profiler.disable()
+        profile_path = os.path.join(self.backdir, 'profile-%s' % os.getpid())
+        pstats.Stats(self.profiler).dump_stats(profile_path)
     stats_path = os.path.join(self.backdir, 'stats-%s' % os.getpid())
     with open(stats_path, 'wb') as stats_f:
         pickle.dump(self.parser.stats, stats_f)
 
-def with_max_exceptions(fn):
-    @functools.wraps(fn)
-    def wrapper(*args, **kwds):
-        try:
-            return fn(*args, **kwds)
-        except:
-            traceback.print_exc()
-            self.exception_count += 1
-            if self.exception_count > MAX_EXCEPTIONS_PER_SUBPROCESS:
-                logger.error('Too many exceptions, quitting!')
-                raise
-    return wrapper
-
-@with_max_exceptions
-def work(pageids):
-    rows = []
-    results = query_pageids(self.wiki, pageids)
-    for pageid, title, wikitext in results:
-        url = WIKIPEDIA_WIKI_URL + title.replace(' ', '_')
-
-        snippets_rows = []
-        snippets = self.parser.extract(wikitext)
-        for snippet in snippets:
+def prepare(wikitext):
+    return self.parser.prepare(wikitext)
+
+def extract(pageid, title, rev_id, sections, htmls):
+    snippets_rows = []
+    for section, html in zip(sections, htmls):
+        if html is None:
+            continue
+        for snippet in self.parser.extract_from_html(section, html):
             sec = section_name_to_anchor(snippet.section)
-            id = mkid(title + snippet.snippet)
+            id = chdb.encode_id(mkid(title + snippet.snippet))
             oldest_template_date = snippet.dates[-1] if snippet.dates else None
             row = (id, snippet.snippet, sec, pageid, oldest_template_date)
             snippets_rows.append(row)
 
-        if snippets_rows:
-            article_row = (pageid, url, title)
-            rows.append({'article': article_row, 'snippets': snippets_rows})
-
-    def insert(cursor, r):
-        cursor.execute('''
-            INSERT INTO articles VALUES(%s, %s, %s)''', r['article'])
+    if not snippets_rows:
+        return None
+    url = WIKIPEDIA_WIKI_URL + title.replace(' ', '_')
+    article_row = (pageid, url, title, rev_id)
+    return {'article': article_row, 'snippets': snippets_rows}
+
+def insert(cursor, r):
+    cursor.execute('''
+        INSERT INTO articles (page_id, url, title, rev_id)
+        VALUES(%s, %s, %s, %s)''', r['article'])
+    cursor.executemany('''
+        INSERT IGNORE INTO snippets (id, snippet, section, article_id,
+        oldest_template_date) VALUES(%s, %s, %s, %s, %s)''',
+        r['snippets'])
+
+    # We can't allow data to be truncated for HTML snippets, as that can
+    # completely break the UI, so we detect truncation warnings and get rid
+    # of the corresponding data.
+    warnings = cursor.execute('SHOW WARNINGS')
+    truncated_snippets = []
+    for _, _, message in cursor.fetchall():
+        m = DATA_TRUNCATED_WARNING_RE.match(message)
+        if m is None:
+            # Not a truncation, ignore (it's already logged)
+            continue
+        # MySQL warnings index rows starting at 1
+        idx = int(m.groups()[0]) - 1
+        truncated_snippets.append((r['snippets'][idx][0],))
+    if len(truncated_snippets) < len(r['snippets']):
         cursor.executemany('''
-            INSERT IGNORE INTO snippets VALUES(%s, %s, %s, %s, %s)''',
-            r['snippets'])
-
-        # We can't allow data to be truncated for HTML snippets, as that can
-        # completely break the UI, so we detect truncation warnings and get rid
-        # of the corresponding data.
-        warnings = cursor.execute('SHOW WARNINGS')
-        truncated_snippets = []
-        for _, _, message in cursor.fetchall():
-            m = DATA_TRUNCATED_WARNING_RE.match(message)
-            if m is None:
-                # Not a truncation, ignore (it's already logged)
-                continue
-            # MySQL warnings index rows starting at 1
-            idx = int(m.groups()[0]) - 1
-            truncated_snippets.append((r['snippets'][idx][0],))
-        if len(truncated_snippets) < len(r['snippets']):
-            cursor.executemany('''
-                DELETE FROM snippets WHERE id = %s''', truncated_snippets)
-        else:
-            # Every single snippet was truncated, remove the article itself
-            cursor.execute('''DELETE FROM articles WHERE page_id = %s''',
-                (r['article'][0],))
+            DELETE FROM snippets WHERE id = %s''', truncated_snippets)
+    else:
+        # Every single snippet was truncated, remove the article itself
+        cursor.execute('''DELETE FROM articles WHERE page_id = %s''',
+            (r['article'][0],))
+
+def insert_rows(rows):
     # Open a short-lived connection to try to avoid the limit of 20 per user:
     # https://phabricator.wikimedia.org/T216170
     db = chdb.init_scratch_db()
     for r in rows:
         db.execute_with_retry(insert, r)
 
-def parse_live(pageids, timeout):
-    backdir = tempfile.mkdtemp(prefix = 'citationhunt_parse_live_')
-    pool = multiprocessing.Pool(
-        # The number of processes per CPU is pretty much made up. The processes
-        # are I/O bound as most of the time is spent querying the Wikipedia API.
-        processes = multiprocessing.cpu_count() * 4,
-        initializer = initializer, initargs = (backdir,))
-
-    # Make sure we query the API 32 pageids at a time
-    tasks = []
-    batch_size = 32
-    pageids_list = list(pageids)
-    for i in range(0, len(pageids), batch_size):
-        tasks.append(pageids_list[i:i+batch_size])
+def get_unchanged_pageids(pageids):
+    '''
+    Returns the pageids in `pageids` whose latest revision is the one that
+    was parsed for the live database.
+    '''
+    db = chdb.init_scratch_db()
+    live_articles = chdb.get_table_name(db, 'citationhunt', 'articles')
+    database, table = live_articles.split('.')
+    has_rev_id = db.execute_with_retry_s('''
+        SELECT COUNT(*) FROM information_schema.COLUMNS
+        WHERE TABLE_SCHEMA = %s AND TABLE_NAME = %s AND
+        COLUMN_NAME = %s''', database, table, 'rev_id')[0][0]
+    if not has_rev_id:
+        # The live database predates revision ids, we have to parse
+        # everything once.
+        return set()
+    if not chdb.live_tables_match_id_format(db):
+        # The compact_ids setting changed, so we can't copy the snippets.
+        return set()
+    live_rev_ids = dict(db.execute_with_retry_s('''
+        SELECT page_id, rev_id FROM %s
+        WHERE rev_id IS NOT NULL''' % live_articles) or [])
+
+    def load_latest_revisions(cursor, pageids):
+        cursor.execute('''
+            SELECT page_id, page_latest FROM page WHERE page_id IN %s''',
+            (pageids,))
+        return cursor.fetchall()
+
+    wpdb = chdb.init_wp_replica_db(cfg.lang_code)
+    unchanged = set()
+    candidates = [p for p in pageids if int(p) in live_rev_ids]
+    for c in ichunk(candidates, 10000):
+        for page_id, page_latest in wpdb.execute_with_retry(
+            load_latest_revisions, tuple(c)):
+            if live_rev_ids[page_id] == page_latest:
+                unchanged.add(str(page_id))
+    return unchanged
+
+def copy_unchanged_articles(pageids):
+    '''
+    Copies the articles in `pageids`, and their snippets, from the live
+    database into the scratch database.
+    '''
+    def copy(cursor, live_articles, live_snippets, pageids):
+        cursor.execute('''
+            INSERT INTO articles (page_id, url, title, rev_id)
+            SELECT page_id, url, title, rev_id FROM %s
+            WHERE page_id IN %%s''' % live_articles, (pageids,))
+        cursor.execute('''
+            INSERT IGNORE INTO snippets (id, snippet, section, article_id,
+            oldest_template_date)
+            SELECT id, snippet, section, article_id, oldest_template_date
+            FROM %s WHERE article_id IN %%s''' % live_snippets, (pageids,))
 
-    result = pool.map_async(work, tasks)
-    pool.close()
+    db = chdb.init_scratch_db()
+    live_articles = chdb.get_table_name(db, 'citationhunt', 'articles')
+    live_snippets = chdb.get_table_name(db, 'citationhunt', 'snippets')
+    for c in ichunk(pageids, 1000):
+        db.execute_with_retry(copy, live_articles, live_snippets, tuple(c))
+
+class RateLimiter:
+    '''Spaces out calls to wait() to at most `rate` per second.'''
+
+    def __init__(self, rate):
+        self._interval = 1.0 / rate if rate else 0
+        self._next = 0
+
+    async def wait(self):
+        if not self._interval:
+            return
+        now = time.monotonic()
+        delay = self._next - now
+        self._next = max(now, self._next) + self._interval
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+class Pipeline:
+    '''
+    Fetches and parses articles, then stores their snippets.
+
+    The main process runs an event loop that keeps up to
+    parse_live_api_concurrency requests to the Wikipedia API in flight
+    (fetching articles and rendering their sections to HTML) over a shared
+    pool of keep-alive connections, and hands the articles over to
+    `process_pool` for parsing. Each article's sections are rendered with a
+    single call to SnippetParser.render_all, which only makes more than one
+    request if it has to fall back to rendering them one by one. Up to parse_live_max_pending_articles
+    articles are in the pipeline at any time.
+    '''
+
+    def __init__(self, process_pool, html_cache):
+        self._loop = asyncio.get_event_loop()
+        self._process_pool = process_pool
+
+        concurrency = cfg.parse_live_api_concurrency
+        self._api_executor = concurrent.futures.ThreadPoolExecutor(concurrency)
+        self._api_semaphore = asyncio.Semaphore(concurrency)
+        self._rate_limiter = RateLimiter(cfg.parse_live_api_requests_per_second)
+        # A single thread, so we only use one database connection at a time.
+        self._db_executor = concurrent.futures.ThreadPoolExecutor(1)
+        self._batch_semaphore = asyncio.Semaphore(max(1,
+            cfg.parse_live_max_pending_articles // PAGEIDS_BATCH_SIZE))
+
+        self._wiki = cfg.wikipedia
+        adapter = requests.adapters.HTTPAdapter(
+            pool_maxsize = concurrency,
+            max_retries = self._wiki.options.http_retries)
+        self._wiki.session.mount('https://', adapter)
+        self._html_cache = html_cache
+        # Each thread of _api_executor renders with its own parser, so they
+        # don't update the same stats concurrently (see _get_parser).
+        self._thread_local = threading.local()
+        self._parsers = []
+        self._parsers_lock = threading.Lock()
+
+        self._rows = []
+        self._exception_count = 0
+
+    def _on_exception(self):
+        traceback.print_exc()
+        self._exception_count += 1
+        if self._exception_count > MAX_EXCEPTIONS:
+            raise TooManyExceptions()
+
+    async def _call_api(self, fn, *args):
+        async with self._api_semaphore:
+            await self._rate_limiter.wait()
+            return await self._loop.run_in_executor(
+                self._api_executor, fn, *args)
+
+    async def _flush_rows(self):
+        rows, self._rows = self._rows, []
+        if not rows:
+            return
+        try:
+            await self._loop.run_in_executor(
+                self._db_executor, insert_rows, rows)
+        except Exception:
+            self._on_exception()
+
+    def _get_parser(self):
+        parser = getattr(self._thread_local, 'parser', None)
+        if parser is None:
+            parser = snippet_parser.create_snippet_parser(
+                self._wiki, cfg, self._html_cache)
+            self._thread_local.parser = parser
+            with self._parsers_lock:
+                self._parsers.append(parser)
+        return parser
+
+    def _render_all(self, sections):
+        return self._get_parser().render_all(sections)
+
+    async def _process_article(self, pageid, title, wikitext, rev_id):
+        try:
+            sections = await self._loop.run_in_executor(
+                self._process_pool, prepare, wikitext)
+            htmls = await self._call_api(self._render_all, sections)
+            row = await self._loop.run_in_executor(
+                self._process_pool, extract, pageid, title, rev_id,
+                sections, htmls)
+        except Exception:
+            self._on_exception()
+            return
+        if row is not None:
+            self._rows.append(row)
+            if len(self._rows) >= INSERT_BATCH_SIZE:
+                await self._flush_rows()
+
+    async def _process_batch(self, pageids):
+        async with self._batch_semaphore:
+            try:
+                articles = await self._call_api(
+                    lambda: list(query_pageids(self._wiki, pageids)))
+            except Exception:
+                self._on_exception()
+                return
+            await asyncio.gather(*(
+                self._process_article(*article) for article in articles))
+
+    @property
+    def stats(self):
+        with self._parsers_lock:
+            parsers = list(self._parsers)
+        return snippet_parser.stats.merge_stats(p.stats for p in parsers)
+
+    async def run(self, pageids):
+        pageids_list = list(pageids)
+        tasks = [
+            asyncio.ensure_future(self._process_batch(
+                pageids_list[i:i+PAGEIDS_BATCH_SIZE]))
+            for i in range(0, len(pageids_list), PAGEIDS_BATCH_SIZE)
+        ]
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            # On timeout or too many exceptions, stop what's in flight but
+            # still store the articles we've already parsed.
+            for t in tasks:
+                t.cancel()
+            await asyncio.gather(*tasks, return_exceptions = True)
+            await self._flush_rows()
+            self._api_executor.shutdown()
+            self._db_executor.shutdown()
+
+def parse_live(pageids, timeout, incremental):
+    if incremental:
+        unchanged = get_unchanged_pageids(pageids)
+        logger.info('copying %d unchanged articles from the live database' % (
+            len(unchanged)))
+        copy_unchanged_articles(unchanged)
+        pageids = set(pageids) - unchanged
+        logger.info('parsing %d new or changed articles' % len(pageids))
 
-    if timeout is not None:
-        result.wait(timeout)
-    else:
-        result.wait()
-    if not result.ready():
-        logger.info('timeout, canceling the process pool!')
-        pool.terminate()
-    pool.join()
+    backdir = tempfile.mkdtemp(prefix = 'citationhunt_parse_live_')
+    process_pool = concurrent.futures.ProcessPoolExecutor(
+        max_workers = max(1, int(
+            multiprocessing.cpu_count() * cfg.parse_live_processes_per_cpu)),
+        initializer = initializer, initargs = (backdir,))
+    # Make sure the worker processes are started before we create any
+    # threads, as forking a multi-threaded process is asking for trouble.
+    process_pool.submit(os.getpid).result()
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    html_cache = snippet_parser.create_html_cache(cfg)
+    pipeline = Pipeline(process_pool, html_cache)
     try:
-        result.get()
+        loop.run_until_complete(asyncio.wait_for(
+            pipeline.run(pageids), timeout))
+        ret = 0
+    except asyncio.TimeoutError:
+        logger.info('timeout, canceling the pipeline!')
         ret = 0
-    except Exception:
+    except TooManyExceptions:
         logger.error('Too many exceptions, failed!')
         ret = 1
+    loop.close()
+    process_pool.shutdown()
+    chdb.init_scratch_db().execute_with_retry(database.populate_snippets_seq)
+    if html_cache is not None:
+        logger.info('evicted %d entries from the HTML cache' % (
+            html_cache.evict()))
+        html_cache.close()
 
     if cfg.profile:
         profiles = list(map(pstats.Stats,
@@ -221,15 +444,41 @@ def parse_live(pageids, timeout):
         if stats is not None:
             stats.sort_stats('cumulative').print_stats(30)
 
-    parser_stats = snippet_parser.stats.merge_stats(
-        pickle.load(open(stats_file, 'rb'))
-        for stats_file in glob.glob(os.path.join(backdir, 'stats-*')))
+    parser_stats = snippet_parser.stats.merge_stats(itertools.chain(
+        [pipeline.stats],
+        (pickle.load(open(stats_file, 'rb'))
+            for stats_file in glob.glob(os.path.join(backdir, 'stats-*')))))
     lengths = parser_stats.snippet_lengths
     logger.info('percentiles for snippet lengths:')
     logger.info('50th: %d' % snippet_parser.stats.percentile(lengths, 50))
     logger.info('70th: %d' % snippet_parser.stats.percentile(lengths, 70))
     logger.info('90th: %d' % snippet_parser.stats.percentile(lengths, 90))
     logger.info('95th: %d' % snippet_parser.stats.percentile(lengths, 95))
+    api_calls = parser_stats.api_calls_per_article
+    logger.info('percentiles for API calls per article:')
+    logger.info('50th: %d' % snippet_parser.stats.percentile(api_calls, 50))
+    logger.info('90th: %d' % snippet_parser.stats.percentile(api_calls, 90))
+    logger.info('99th: %d' % snippet_parser.stats.percentile(api_calls, 99))
+    logger.info('time spent per stage (total, 50th/90th/99th percentiles):')
+    for stage, seconds in sorted(parser_stats.stage_seconds.items(),
+            key = lambda item: item[1], reverse = True):
+        histogram = parser_stats.stage_ms[stage]
+        logger.info('%s: %.1fs, %d/%d/%d ms' % (stage, seconds,
+            snippet_parser.stats.percentile(histogram, 50),
+            snippet_parser.stats.percentile(histogram, 90),
+            snippet_parser.stats.percentile(histogram, 99)))
+    for stage, count in sorted(parser_stats.fallbacks.items()):
+        logger.info('fallbacks in %s: %d' % (stage, count))
+    for stage, count in sorted(parser_stats.errors.items()):
+        logger.info('errors in %s: %d' % (stage, count))
+    logger.info('skipped %d articles without citation needed templates' % (
+        parser_stats.prefiltered_articles))
+    cache_lookups = (
+        parser_stats.html_cache_hits + parser_stats.html_cache_misses)
+    if cache_lookups:
+        logger.info('HTML cache: %d hits, %d misses (%.1f%% hit rate)' % (
+            parser_stats.html_cache_hits, parser_stats.html_cache_misses,
+            100.0 * parser_stats.html_cache_hits / cache_lookups))
 
     shutil.rmtree(backdir)
     return ret
@@ -243,6 +492,6 @@ if __name__ == '__main__':
     start = time.time()
     with open(pageids_file) as pf:
         pageids = set(map(str.strip, pf))
-    ret = parse_live(pageids, timeout)
+    ret = parse_live(pageids, timeout, arguments['--incremental'])
     logger.info('all done in %d seconds.' % (time.time() - start))
     sys.exit(ret)
@@ -83,6 +83,10 @@ def _update_db_tools_labs(logger, cfg):
     os.environ['CH_LANG'] = cfg.lang_code
     chdb.initialize_all_databases()
 
+    # Look up the redirects to citation needed templates once, the scripts
+    # below will use the cached results.
+    cfg.enable_wikipedia_api(refresh_templates = True)
+
     if cfg.archive_dir and not archive_database(logger, cfg):
         # Log, but don't assert, this is not fatal
         logger.warning('Failed to archive database!')
@@ -99,8 +103,10 @@ def _update_db_tools_labs(logger, cfg):
     unsourced = tempfile.NamedTemporaryFile()
     run_script(
         'print_unsourced_pageids_from_wikipedia.py', '> ' + unsourced.name)
-    run_script('parse_live.py', unsourced.name)
-    run_script('assign_categories.py')
+    run_script('parse_live.py',
+        ('--incremental ' if cfg.incremental_rebuild else '') + unsourced.name)
+    run_script('assign_categories.py',
+        '--streaming' if cfg.streaming_category_assignment else '')
     run_script('update_intersections.py')
     run_script('install_new_database.py')
 
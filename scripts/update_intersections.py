@@ -16,6 +16,10 @@ def update_intersections():
     cfg = config.get_localized_config()
 
     db.execute_with_retry_s('DELETE FROM intersections')
+    if not chdb.live_tables_match_id_format(db):
+        # The compact_ids setting changed and the existing intersections
+        # can't be copied over, so they're lost.
+        return
     db.execute_with_retry_s('''
         INSERT INTO intersections SELECT * FROM %s
         WHERE expiration > NOW()''' % chdb.get_table_name(
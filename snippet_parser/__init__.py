@@ -3,3 +3,4 @@ from .core import (
     SNIPPET_WRAPPER_CLASS,
     create_snippet_parser
 )
+from .html_cache import create_html_cache
@@ -0,0 +1,406 @@
+'''
+Benchmark harness for SnippetParser.
+
+Runs SnippetParser.extract over a corpus of articles without talking to
+Wikipedia, and reports pages per second, the time spent in each stage of
+parsing and the peak memory allocated while parsing a page, per language.
+
+A corpus is a directory with one subdirectory per language code, each
+containing:
+
+    manifest.json  The corpus version, the citation needed templates
+                   (including redirects) at the time it was recorded, and
+                   the title and wikitext file of each page.
+    pages/         The wikitext of each page.
+    responses/     The HTML returned by the Parse API for each request made
+                   while parsing the pages, named after HTMLCache.make_key.
+
+Use the `record` command to create one from live Wikipedia. Without a
+corpus, a synthetic English corpus is used, and the HTML comes from a crude
+offline renderer, which also stands in for any requests that are missing from
+a recorded corpus (for instance, after changing how sections are marked up).
+
+The `pruning` command compares the time and peak memory used to prune the
+token stream in _fast_parse against the previous implementation, which walked
+zip(tokens, tokens[1:]) and copied the slices for each section.
+
+Usage:
+    benchmark.py record <corpus-dir> <lang-code> <pageid>...
+    benchmark.py pruning
+    benchmark.py [<corpus-dir>] [--repeat=<n>]
+
+Options:
+    --repeat=<n>    How many times to parse the corpus [default: 3].
+'''
+
+import os
+import sys
+_upper_dir = os.path.abspath(
+    os.path.join(os.path.dirname(__file__), '..'))
+if _upper_dir not in sys.path:
+    sys.path.append(_upper_dir)
+
+import config
+from . import core
+from . import html_cache
+from utils import *
+
+import docopt
+import mwparserfromhell
+
+import json
+import random
+import re
+import time
+import timeit
+import tracemalloc
+
+# Bump this when changing the format of the corpus.
+CORPUS_VERSION = 1
+
+# The order in which SnippetParser goes through its stages.
+_STAGES = [
+    'tokenize', 'prune_tokens', 'build', 'full_parse', 'mark_templates',
+    'render', 'split_batch', 'html_parse', 'css_strip', 'find_snippets',
+    'serialize_snippets',
+]
+
+class BenchmarkConfig(object):
+    lang_code = 'en'
+    extract = 'snippet'
+    snippet_min_size = 100
+    snippet_max_size = 1000
+    html_parse_parameters = {}
+    citation_needed_templates = ['Citation needed', 'cn', 'fact']
+    html_css_selectors_to_strip = (
+        config.get_localized_config('en').html_css_selectors_to_strip)
+    batch_section_rendering = True
+
+_WORDS = (
+    'the of and in to was for on as with by is at from his that it an were '
+    'which are this also be has had or first one their its new after who '
+    'they two her she been other when there all during into school time may '
+    'years more most only over city some world would where later up such '
+    'used many can state about national out known university united then '
+    'made'.split())
+
+def _paragraph(rng, cn_probability):
+    words = []
+    for _ in range(rng.randint(40, 120)):
+        r = rng.random()
+        if r < 0.05:
+            words.append('[[%s %s]]' % (rng.choice(_WORDS), rng.choice(_WORDS)))
+        elif r < 0.07:
+            words.append("''%s''" % rng.choice(_WORDS))
+        elif r < 0.08:
+            words.append(
+                '<ref>{{cite web |url=https://example.org/%d |title=%s}}'
+                '</ref>' % (rng.randint(0, 10**6), rng.choice(_WORDS)))
+        else:
+            words.append(rng.choice(_WORDS))
+    text = ' '.join(words) + '.'
+    if rng.random() < cn_probability:
+        text += '{{Citation needed|date=January 2020}}'
+    return text
+
+def make_article(rng, sections, cn_probability = 0.02):
+    '''A long article with about `cn_probability` paragraphs lacking
+    citations.'''
+    parts = ['{{Infobox thing |name=Thing |image=Thing.png}}',
+        _paragraph(rng, cn_probability)]
+    for i in range(sections):
+        parts.append('== Section %d ==' % i)
+        for _ in range(rng.randint(2, 6)):
+            parts.append(_paragraph(rng, cn_probability))
+        if rng.random() < 0.1:
+            parts.append('{| class="wikitable"\n|-\n| a || b\n|}')
+    return '\n\n'.join(parts)
+
+def make_corpus(articles = 20, sections = 150, seed = 0):
+    rng = random.Random(seed)
+    return [make_article(rng, sections) for _ in range(articles)]
+
+def legacy_reduce_tokens(parser, tokens):
+    '''Prunes the token stream like _fast_parse used to.'''
+    tokens.append(mwparserfromhell.parser.tokens.HeadingStart())
+    reduced_tokens = []
+    prev_section_idx = 0
+    section_has_citation_needed = False
+    for i, (t1, t2) in enumerate(zip(tokens, tokens[1:])):
+        if isinstance(t2, mwparserfromhell.parser.tokens.HeadingStart):
+            if section_has_citation_needed:
+                reduced_tokens.extend(tokens[prev_section_idx:i+1])
+            prev_section_idx = i+1
+            section_has_citation_needed = False
+        section_has_citation_needed |= (
+            isinstance(t1, mwparserfromhell.parser.tokens.TemplateOpen) and
+            isinstance(t2, mwparserfromhell.parser.tokens.Text) and
+            t2.text.lower().strip() in parser._lowercase_cn_templates)
+    return reduced_tokens
+
+def _tokenize(wikitext):
+    return mwparserfromhell.parser.CTokenizer().tokenize(wikitext, 0, True)
+
+def _measure(fn, token_lists, repeat = 3):
+    '''Returns the best time per article and the highest peak memory
+    allocated while running `fn` over each token list.'''
+    def run():
+        for tokens in token_lists:
+            fn(list(tokens))
+    seconds = min(timeit.repeat(run, number = 1, repeat = repeat))
+
+    peak = 0
+    for tokens in token_lists:
+        tokens = list(tokens)
+        tracemalloc.start()
+        fn(tokens)
+        peak = max(peak, tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+    return seconds / len(token_lists), peak
+
+_REF_RE = re.compile(r'<ref[^>/]*(?:/>|>.*?</ref>)', re.DOTALL)
+_TABLE_RE = re.compile(r'^\{\|.*?^\|\}', re.DOTALL | re.MULTILINE)
+_TEMPLATE_RE = re.compile(r'\{\{[^{}]*\}\}')
+_LINK_RE = re.compile(r'\[\[(?:[^|\]]*\|)?([^\]]*)\]\]')
+_BOLD_RE = re.compile(r"'''(.*?)'''")
+_ITALIC_RE = re.compile(r"''(.*?)''")
+_HEADING_RE = re.compile(r'^(=+)\s*(.*?)\s*\1$')
+
+def offline_render(wikitext):
+    '''
+    A crude stand-in for the Parse API. Renders paragraphs, headings, lists,
+    links and references, passes HTML through, and expands all templates
+    (including citation needed templates) to placeholders.
+    '''
+    text = _REF_RE.sub('<sup class="reference">[1]</sup>', wikitext)
+    text = _TABLE_RE.sub('<table><tr><td>Table</td></tr></table>', text)
+    # Innermost templates first, until there are none left.
+    previous = None
+    while previous != text:
+        previous, text = text, _TEMPLATE_RE.sub(
+            '<sup class="noprint">[template]</sup>', text)
+    text = _LINK_RE.sub(r'<a href="#">\1</a>', text)
+    text = _BOLD_RE.sub(r'<b>\1</b>', text)
+    text = _ITALIC_RE.sub(r'<i>\1</i>', text)
+
+    html, paragraph, list_items = [], [], []
+    def flush():
+        if paragraph:
+            html.append('<p>%s</p>' % ' '.join(paragraph))
+            del paragraph[:]
+        if list_items:
+            html.append('<ul>%s</ul>' % ''.join(
+                '<li>%s</li>' % li for li in list_items))
+            del list_items[:]
+    for line in text.split('\n'):
+        line = line.strip()
+        heading = _HEADING_RE.match(line)
+        if heading:
+            flush()
+            level = len(heading.group(1))
+            html.append('<h%d>%s</h%d>' % (level, heading.group(2), level))
+        elif line.startswith(('*', '#')):
+            if paragraph:
+                flush()
+            list_items.append(line.lstrip('*# '))
+        elif line.startswith(('<div', '<table')):
+            flush()
+            html.append(line)
+        elif line:
+            if list_items:
+                flush()
+            paragraph.append(line)
+        else:
+            flush()
+    flush()
+    return '\n'.join(html)
+
+class FakeWikipedia(object):
+    '''
+    Serves Parse API responses from a corpus' responses directory, falling
+    back to offline_render for those that weren't recorded.
+    '''
+
+    def __init__(self, responses_dir = None):
+        self._responses_dir = responses_dir
+        self.recorded = 0
+        self.rendered_offline = 0
+
+    def parse(self, params):
+        params = dict(params)
+        text = params.pop('text')
+        html = None
+        if self._responses_dir is not None:
+            key = html_cache.HTMLCache.make_key(text, params).hex()
+            try:
+                with open(os.path.join(
+                    self._responses_dir, key + '.html')) as f:
+                    html = f.read()
+            except FileNotFoundError:
+                pass
+        if html is not None:
+            self.recorded += 1
+        else:
+            self.rendered_offline += 1
+            html = offline_render(text)
+        return {'parse': {'text': {'*': html}}}
+
+class RecordingWikipedia(object):
+    '''Saves the Parse API responses from `wikipedia` to `responses_dir`.'''
+
+    def __init__(self, wikipedia, responses_dir):
+        self._wikipedia = wikipedia
+        self._responses_dir = responses_dir
+
+    def parse(self, params):
+        response = self._wikipedia.parse(params)
+        params = dict(params)
+        text = params.pop('text')
+        key = html_cache.HTMLCache.make_key(text, params).hex()
+        with open(os.path.join(self._responses_dir, key + '.html'), 'w') as f:
+            f.write(response['parse']['text']['*'])
+        return response
+
+def record(corpus_dir, lang_code, pageids):
+    cfg = config.get_localized_config(lang_code)
+    cfg.enable_wikipedia_api()
+    lang_dir = os.path.join(corpus_dir, lang_code)
+    os.makedirs(os.path.join(lang_dir, 'pages'), exist_ok = True)
+    os.makedirs(os.path.join(lang_dir, 'responses'), exist_ok = True)
+    parser = core.create_snippet_parser(RecordingWikipedia(
+        cfg.wikipedia, os.path.join(lang_dir, 'responses')), cfg)
+
+    pages = []
+    # The API takes up to 50 pageids at a time.
+    for chunk in ichunk(pageids, 50):
+        params = {
+            'pageids': '|'.join(chunk),
+            'prop': 'revisions',
+            'rvprop': 'content',
+            'rvslots': 'main'
+        }
+        for response in cfg.wikipedia.query(params):
+            for id, page in response['query']['pages'].items():
+                if 'revisions' not in page:
+                    continue
+                wikitext = page['revisions'][0]['slots']['main']['*']
+                filename = os.path.join('pages', id + '.wikitext')
+                with open(os.path.join(lang_dir, filename), 'w') as f:
+                    f.write(wikitext)
+                pages.append({'title': page['title'], 'file': filename})
+                parser.extract(wikitext)
+                print('recorded %s' % page['title'])
+
+    with open(os.path.join(lang_dir, 'manifest.json'), 'w') as f:
+        json.dump({
+            'version': CORPUS_VERSION,
+            'citation_needed_templates': sorted(
+                cfg.citation_needed_templates),
+            'pages': pages,
+        }, f, indent = 2)
+
+def load_corpus(corpus_dir):
+    '''
+    Yields a (config, list of wikitext, FakeWikipedia) tuple for each
+    language in `corpus_dir`.
+    '''
+    for lang_code in sorted(os.listdir(corpus_dir)):
+        lang_dir = os.path.join(corpus_dir, lang_code)
+        with open(os.path.join(lang_dir, 'manifest.json')) as f:
+            manifest = json.load(f)
+        if manifest['version'] != CORPUS_VERSION:
+            raise ValueError('%s has version %s, expected %s' % (
+                lang_dir, manifest['version'], CORPUS_VERSION))
+        cfg = config.get_localized_config(lang_code)
+        cfg.citation_needed_templates = manifest['citation_needed_templates']
+        wikitexts = []
+        for page in manifest['pages']:
+            with open(os.path.join(lang_dir, page['file'])) as f:
+                wikitexts.append(f.read())
+        yield cfg, wikitexts, FakeWikipedia(
+            os.path.join(lang_dir, 'responses'))
+
+def benchmark(cfg, wikitexts, wikipedia, repeat):
+    '''
+    Returns the best pages per second over `repeat` runs, the stats for
+    that run and the peak memory allocated while parsing any one page.
+    '''
+    best_seconds, best_stats = None, None
+    for _ in range(repeat):
+        parser = core.create_snippet_parser(wikipedia, cfg)
+        start = time.perf_counter()
+        for wikitext in wikitexts:
+            parser.extract(wikitext)
+        seconds = time.perf_counter() - start
+        if best_seconds is None or seconds < best_seconds:
+            best_seconds, best_stats = seconds, parser.stats
+
+    parser = core.create_snippet_parser(wikipedia, cfg)
+    peak = 0
+    for wikitext in wikitexts:
+        tracemalloc.start()
+        parser.extract(wikitext)
+        peak = max(peak, tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+    return len(wikitexts) / best_seconds, best_stats, peak
+
+def run(corpus_dir, repeat):
+    if corpus_dir is None:
+        corpus = [(BenchmarkConfig(), make_corpus(), FakeWikipedia())]
+    else:
+        corpus = load_corpus(corpus_dir)
+    for cfg, wikitexts, wikipedia in corpus:
+        print('%s: %d pages, %d KiB on average' % (
+            cfg.lang_code, len(wikitexts),
+            sum(map(len, wikitexts)) / len(wikitexts) / 1024))
+        pages_per_s, stats, peak = benchmark(
+            cfg, wikitexts, wikipedia, repeat)
+        print('  %.1f pages/s, %d KiB peak memory per page' % (
+            pages_per_s, peak / 1024))
+        total = sum(stats.stage_seconds.values())
+        for stage in _STAGES:
+            seconds = stats.stage_seconds.get(stage, 0)
+            print('  %-20s %8.2f ms/page %5.1f%%' % (
+                stage, seconds * 1e3 / len(wikitexts),
+                100 * seconds / total if total else 0))
+        print('  Parse API requests: %d recorded, %d rendered offline' % (
+            wikipedia.recorded, wikipedia.rendered_offline))
+
+def compare_pruning():
+    parser = core.create_snippet_parser(None, BenchmarkConfig())
+    corpus = make_corpus()
+    token_lists = [_tokenize(wikitext) for wikitext in corpus]
+    print('%d articles, %d KiB and %d tokens on average' % (
+        len(corpus), sum(map(len, corpus)) / len(corpus) / 1024,
+        sum(map(len, token_lists)) / len(token_lists)))
+
+    # Make sure we're comparing apples to apples.
+    for tokens in token_lists:
+        assert (legacy_reduce_tokens(parser, list(tokens)) ==
+            parser._reduce_tokens(list(tokens)))
+
+    results = [
+        ('zip + slices (previous)',
+            _measure(lambda t: legacy_reduce_tokens(parser, t), token_lists)),
+        ('index ranges', _measure(parser._reduce_tokens, token_lists)),
+    ]
+    print('pruning the token stream:')
+    for name, (seconds, peak) in results:
+        print('  %-30s %8.2f ms/article %8d KiB peak' % (
+            name, seconds * 1e3, peak / 1024))
+
+    seconds = min(timeit.repeat(
+        lambda: [parser._fast_parse(w) for w in corpus],
+        number = 1, repeat = 3)) / len(corpus)
+    print('_fast_parse (tokenizing + pruning + building): %.2f ms/article' % (
+        seconds * 1e3))
+
+if __name__ == '__main__':
+    arguments = docopt.docopt(__doc__)
+    if arguments['record']:
+        record(arguments['<corpus-dir>'], arguments['<lang-code>'],
+            arguments['<pageid>'])
+    elif arguments['pruning']:
+        compare_pruning()
+    else:
+        run(arguments['<corpus-dir>'], int(arguments['--repeat']))
@@ -21,6 +21,7 @@ import lxml.cssselect
 import datetime
 import io as StringIO
 import itertools
+import re
 from copy import copy
 
 SNIPPET_WRAPPER_CLASS = 'ch-snippet'
@@ -31,6 +32,11 @@ _CITATION_NEEDED_MARKER_MARKUP = (
     '<span class="%s" %s="{tpl_id}">{tpl}</span>' % \
         (CITATION_NEEDED_MARKER_CLASS, _TEMPLATE_ID_ATTR))
 
+# Separates the sections of an article when converting them to HTML together.
+_SECTION_SEPARATOR_ATTR = 'data-ch-section-separator'
+_SECTION_SEPARATOR_MARKUP = (
+    '\n\n<div %s="{index}"></div>\n\n' % _SECTION_SEPARATOR_ATTR)
+
 _LIST_TAGS = set(['ol', 'ul'])
 _SNIPPET_ROOT_TAGS = set(['p']) | _LIST_TAGS
 
@@ -56,21 +62,58 @@ class Snippet:
     def __hash__(self):
         return hash((self.section, self.snippet))
 
+class MarkedSection:
+    '''A section of an article, ready to be rendered to HTML.
+
+    title (str) is the title of the section, without markup.
+    wikitext (str) is the wikitext of the section, with the citation needed
+             templates in it surrounded by markers.
+    template_data (dict) maps the ids in the markers to the dates in the
+                  corresponding templates.
+    '''
+
+    __slots__ = ('title', 'wikitext', 'template_data')
+
+    def __init__(self, title, wikitext, template_data):
+        self.title = title
+        self.wikitext = wikitext
+        self.template_data = template_data
+
 class SnippetParser:
     '''Turn wikitext into HTML snippets for Citation Hunt.'''
 
-    def __init__(self, wikipedia, cfg):
+    def __init__(self, wikipedia, cfg, html_cache = None):
         self._cfg = cfg
         self._wikipedia = wikipedia
+        self._html_cache = html_cache
 
         self._lowercase_cn_templates = set(
             t.lower() for t in self._cfg.citation_needed_templates)
         assert len(self._lowercase_cn_templates) > 0
 
-        self._html_css_selectors_to_strip = [
-            lxml.cssselect.CSSSelector(css_selector)
-            for css_selector in self._cfg.html_css_selectors_to_strip
-        ]
+        # A quick check for whether an article may contain any citation
+        # needed templates, before we do any actual parsing. Longer names go
+        # first so the alternation doesn't stop at a prefix.
+        self._citation_needed_prefilter_re = re.compile(
+            r'\{\{\s*(?:%s)' % '|'.join(
+                re.escape(t) for t in sorted(
+                    self._lowercase_cn_templates, key = len, reverse = True)),
+            re.IGNORECASE)
+
+        # All the selectors to strip as a single XPath expression, so we
+        # find all the elements to remove in one pass over the tree. Make
+        # sure we don't remove elements inside the markers: for a few
+        # Wikipedias (Chinese, Russian) the expansion of {{fact}} is marked
+        # as .noprint, which we otherwise want to remove.
+        self._html_xpath_to_strip = None
+        if self._cfg.html_css_selectors_to_strip:
+            self._html_xpath_to_strip = lxml.etree.XPath(
+                '(%s)[not(ancestor::span[@class="%s"])]' % (
+                    ' | '.join(
+                        '(%s)' % lxml.cssselect.CSSSelector(css_selector).path
+                        for css_selector
+                        in self._cfg.html_css_selectors_to_strip),
+                    CITATION_NEEDED_MARKER_CLASS))
 
         self.stats = stats.SnippetParserStats()
 
@@ -92,42 +135,69 @@ class SnippetParser:
         try:
             # Passing skip_style_tags helps us get around some builder exceptions,
             # see https://github.com/earwig/mwparserfromhell/issues/40
-            tokens = tokenizer.tokenize(wikitext, 0, True)
+            with self.stats.timer('tokenize'):
+                tokens = tokenizer.tokenize(wikitext, 0, True)
         except SystemError:
             # FIXME This happens sometimes on Tools Labs, why?
+            self.stats.errors['tokenize'] += 1
             return None
 
-        # Add a sentinel representing a "end of article" section
-        tokens.append(mwparserfromhell.parser.tokens.HeadingStart())
-
         # Slice the original token stream into a (potentially much smaller) stream
         # consisting only of the tokens in sections that contain citation needed
         # templates. We can then build the parser tree out of those as usual, which
         # is a more expensive operation.
-        reduced_tokens = []
-        prev_section_idx = 0
-        section_has_citation_needed = False
-        for i, (t1, t2) in enumerate(zip(tokens, tokens[1:])):
-            if isinstance(t2, mwparserfromhell.parser.tokens.HeadingStart):
-                if section_has_citation_needed:
-                    reduced_tokens.extend(tokens[prev_section_idx:i+1])
-                prev_section_idx = i+1
-                section_has_citation_needed = False
-
-            # We detect a citation needed template by looking at a TemplateOpen
-            # token followed by a suitable Text token
-            section_has_citation_needed |= (
-                isinstance(t1, mwparserfromhell.parser.tokens.TemplateOpen) and
-                isinstance(t2, mwparserfromhell.parser.tokens.Text) and
-                t2.text.lower().strip() in self._lowercase_cn_templates)
+        with self.stats.timer('prune_tokens'):
+            reduced_tokens = self._reduce_tokens(tokens)
         try:
-            wikicode = mwparserfromhell.parser.Builder().build(reduced_tokens)
+            with self.stats.timer('build'):
+                wikicode = mwparserfromhell.parser.Builder().build(
+                    reduced_tokens)
             if wikicode:
                 return wikicode
             return None
         except mwparserfromhell.parser.ParserError:
+            self.stats.errors['build'] += 1
             return None
 
+    def _reduce_tokens(self, tokens):
+        """
+        Returns the tokens in `tokens` that are part of sections containing
+        citation needed templates, in order.
+
+        We only keep track of the boundaries of the sections to keep, and
+        copy their tokens once at the end, to avoid making copies of (large
+        parts of) the token list for very long articles.
+        """
+        HeadingStart = mwparserfromhell.parser.tokens.HeadingStart
+        TemplateOpen = mwparserfromhell.parser.tokens.TemplateOpen
+        Text = mwparserfromhell.parser.tokens.Text
+
+        ranges = []
+        section_start = 0
+        section_has_citation_needed = False
+        previous = None
+        for i, token in enumerate(tokens):
+            if isinstance(token, HeadingStart):
+                if section_has_citation_needed:
+                    ranges.append((section_start, i))
+                section_start = i
+                section_has_citation_needed = False
+            # We detect a citation needed template by looking at a
+            # TemplateOpen token followed by a suitable Text token
+            elif (isinstance(token, Text) and
+                isinstance(previous, TemplateOpen) and
+                token.text.lower().strip() in self._lowercase_cn_templates):
+                section_has_citation_needed = True
+            previous = token
+        if section_has_citation_needed:
+            ranges.append((section_start, len(tokens)))
+
+        if ranges == [(0, len(tokens))]:
+            return tokens
+        return list(itertools.chain.from_iterable(
+            map(tokens.__getitem__, range(start, end))
+            for start, end in ranges))
+
     def extract(self, wikitext):
         """
         This is the main method for extracting HTML snippets out of wiki markup.
@@ -146,26 +216,57 @@ class SnippetParser:
                snippet is within the bounds we're willing to accept, and if so,
                use it.
 
+        Steps 1-2 are implemented in prepare(), step 3 in render_all(), and the
+        rest in extract_from_html(), so callers can perform the (I/O bound)
+        rendering separately from the (CPU bound) rest of the work.
+
         The return value is a list of Snippet objects.
         """
 
+        snippets = []
+        sections = self.prepare(wikitext)
+        for section, html in zip(sections, self.render_all(sections)):
+            if html is None: continue
+            snippets.extend(self.extract_from_html(section, html))
+        return snippets
+
+    def prepare(self, wikitext):
+        """
+        Find the sections in `wikitext` that contain citation needed templates
+        and mark the templates in them.
+
+        Returns a list of MarkedSection objects, to be passed to render() and
+        extract_from_html().
+        """
+
+        if not self._citation_needed_prefilter_re.search(wikitext):
+            # Typically articles that only transclude citation needed
+            # templates through other templates.
+            self.stats.prefiltered_articles += 1
+            return []
+
         wikicode = self._fast_parse(wikitext)
         if wikicode is None:
             # Fall back to full parsing if fast parsing fails
-            wikicode = mwparserfromhell.parse(wikitext)
+            self.stats.fallbacks['full_parse'] += 1
+            with self.stats.timer('full_parse'):
+                wikicode = mwparserfromhell.parse(wikitext)
+        with self.stats.timer('mark_templates'):
+            return self._mark_templates(wikicode)
+
+    def _mark_templates(self, wikicode):
         sections = wikicode.get_sections(
             include_lead = True, include_headings = True, flat = True)
 
-        # Whatever data we want to extract from the templates as wikitext and
-        # use once they are (potentially) turned into snippets after HTML
-        # expansion. We tag templates with a key into this dict before
-        # converting to HTML, then we can extract the key from the HTML that
-        # is returned.
-        template_data = {}
-
-        snippets = []
-        minlen, maxlen = self._cfg.snippet_min_size, self._cfg.snippet_max_size
+        marked_sections = []
         for i, section in enumerate(sections):
+            # Whatever data we want to extract from the templates as wikitext
+            # and use once they are (potentially) turned into snippets after
+            # HTML expansion. We tag templates with a key into this dict before
+            # converting to HTML, then we can extract the key from the HTML
+            # that is returned.
+            template_data = {}
+
             # First, do a pass over the templates to check whether we have
             # citation needed templates in this section (this should always be
             # true when _fast_parse succeeds above), and replace them with our
@@ -193,8 +294,8 @@ class SnippetParser:
                         # This seems to be caused by citation needed templates
                         # inside the parameters of other citation needed
                         # templates. Since this doesn't look particularly
-                        # frequent, just swallow the error here.
-                        # TODO: Get some stats on how often this happens, log it
+                        # frequent, just count the error here.
+                        self.stats.errors['mark_templates'] += 1
                         return []
             if not has_citation_needed_template: continue
 
@@ -204,109 +305,250 @@ class SnippetParser:
                 if ref.has('group'):
                     ref.remove('group')
 
+            sectitle = ''
+            if i != 0:
+                # Re-parse the section title because fast_parse is
+                # configured to ignore style tags (see above and
+                # https://github.com/earwig/mwparserfromhell/issues/40),
+                # but we do want to remove them now with strip_code().
+                sectitle = mwparserfromhell.parse(
+                    str(section.get(0).title).strip()).strip_code()
+
             # Note: we could gain a little speedup here by breaking the section
             # into paragraphs and taking only the paragraphs we want before
             # sending them for parsing, but that's trickier than it looks,
             # since paragraph breaks can happen not just due to '\n\n', and
             # even within template parameters!
+            marked_sections.append(
+                MarkedSection(sectitle, str(section), template_data))
+        return marked_sections
 
-            try:
-                params = dict(
-                    text = str(section), **self._cfg.html_parse_parameters)
+    def render(self, section):
+        """
+        Convert a MarkedSection to HTML using the Parse API.
+
+        Returns the HTML as a string, or None if the API call failed.
+        """
+
+        try:
+            params = dict(
+                text = section.wikitext, **self._cfg.html_parse_parameters)
+            with self.stats.timer('render'):
+                return self._wikipedia.parse(params)['parse']['text']['*']
+        except:
+            self.stats.errors['render'] += 1
+            return None
+
+    def render_batch(self, sections):
+        """
+        Convert a list of MarkedSections to HTML using a single call to the
+        Parse API.
+
+        The sections are rendered together with separator elements between
+        them, which are then used to split the resulting HTML. Returns a list
+        with the HTML for each section, or None if the API call failed or the
+        HTML couldn't be split (for instance, because a section left a tag
+        open around the separator that follows it).
+        """
+
+        wikitext = ''.join(
+            (_SECTION_SEPARATOR_MARKUP.format(index = i) if i else '') +
+            section.wikitext for i, section in enumerate(sections))
+        try:
+            params = dict(text = wikitext, **self._cfg.html_parse_parameters)
+            with self.stats.timer('render'):
                 html = self._wikipedia.parse(params)['parse']['text']['*']
-            except:
-                continue
-
-            tree = lxml.html.parse(
-                StringIO.StringIO(html),
-                parser = lxml.html.HTMLParser(
-                    encoding = 'utf-8', remove_comments = True)).getroot()
-            if tree is None: continue
-
-            for strip_selector in self._html_css_selectors_to_strip:
-                for element in strip_selector(tree):
-                    # Make sure we don't remove elements inside the markers.
-                    # For a few Wikipedias (Chinese, Russian) the expansion of
-                    # {{fact}} is marked as .noprint, which we otherwise want
-                    # to remove.
-                    inside_marker = any(
-                        e.attrib.get('class') == CITATION_NEEDED_MARKER_CLASS
-                        for e in element.iterancestors('span'))
-                    if not inside_marker:
-                        lxml_utils.remove_element(element)
-
-            snippet_roots = []
-            if self._cfg.extract == 'snippet':
-                # We climb up from each marker to the nearest antecessor element
-                # that we can use as a snippet.
-                for marker in tree.cssselect('.' + CITATION_NEEDED_MARKER_CLASS):
-                    root = marker.getparent()
-                    while root is not None and root.tag not in _SNIPPET_ROOT_TAGS:
-                        root = root.getparent()
-                    if root is None:
-                        continue
-                    if root.tag in _LIST_TAGS:
-                        snippet_roots.extend(self._html_list_to_snippets(root))
-                    else:
-                        snippet_roots.append(self._make_snippet_root(root))
+        except:
+            self.stats.errors['render'] += 1
+            return None
+
+        with self.stats.timer('split_batch'):
+            return self._split_batch(html, len(sections))
+
+    def _split_batch(self, html, nsections):
+        tree = self._parse_html(html)
+        if tree is None: return None
+        separators = tree.xpath('//div[@%s]' % _SECTION_SEPARATOR_ATTR)
+        if ([s.attrib[_SECTION_SEPARATOR_ATTR] for s in separators] !=
+            [str(i) for i in range(1, nsections)]):
+            return None
+        parent = separators[0].getparent()
+        if any(s.getparent() is not parent for s in separators):
+            return None
+
+        # Move the contents of the separators' parent into one copy of it per
+        # section, so the HTML for each section looks like we had rendered it
+        # on its own.
+        parts = [
+            lxml.html.Element(parent.tag, dict(parent.attrib))
+            for _ in range(nsections)
+        ]
+        parts[0].text = parent.text
+        i = 0
+        for child in list(parent):
+            if child.attrib.get(_SECTION_SEPARATOR_ATTR) is not None:
+                i += 1
+                parts[i].text = child.tail
             else:
-                # Throw away the actual template, we don't need it.
-                for marker in tree.cssselect('.' + CITATION_NEEDED_MARKER_CLASS):
-                    lxml_utils.remove_element(marker)
-
-                # Keep only snippet root top-level elements within the body
-                # that have any text content (we may have created empty elements
-                # above during cleanup). This is not great as any content within,
-                # say, <blockquote> gets removed entirely, but it's good enough
-                # in most cases.
-                snippet_roots = [
-                    self._make_snippet_root(*(
-                        e for e in tree.cssselect(
-                            'body > ' + ', '.join(_SNIPPET_ROOT_TAGS))
-                        if e.text_content() and not e.text_content().isspace()))
-                ]
-
-            snippets_in_section = set()
-            for sr in snippet_roots:
-                snippet = Snippet()
-
-                # Some last-minute cleanup to shrink the snippet some more.
-                # Remove links and attributes, but make sure to keep the
-                # class in our marker elements, and that there is no space
-                # before it (which we need for the UI).
-                lxml.etree.strip_tags(sr, 'a')
-                markers_in_snippet = sr.cssselect(
-                    '.' + CITATION_NEEDED_MARKER_CLASS)
-                lxml.etree.strip_attributes(sr, 'id', 'class', 'style')
-                sr.attrib['class'] = SNIPPET_WRAPPER_CLASS
-                for marker in markers_in_snippet:
-                    marker.attrib['class'] = CITATION_NEEDED_MARKER_CLASS
-                    tpl_id = marker.attrib[_TEMPLATE_ID_ATTR]
-                    if template_data.get(tpl_id) is not None:
-                        snippet.dates = sorted(snippet.dates +
-                            [template_data[tpl_id]])
-                    del marker.attrib[_TEMPLATE_ID_ATTR]
-                    lxml_utils.strip_space_before_element(marker)
-
-                length = len(sr.text_content().strip())
-                self.stats.snippet_lengths[length] += 1
-                if minlen < length < maxlen:
-                    snippet.snippet = d(lxml.html.tostring(
-                        sr, encoding = 'utf-8', method = 'html')).strip()
-                    snippets_in_section.add(snippet)
+                parts[i].append(child)
+        return [lxml.html.tostring(p, encoding = 'unicode') for p in parts]
 
-            sectitle = ''
-            if i != 0:
-                # Re-parse the section title because fast_parse is
-                # configured to ignore style tags (see above and
-                # https://github.com/earwig/mwparserfromhell/issues/40),
-                # but we do want to remove them now with strip_code().
-                sectitle = mwparserfromhell.parse(
-                    str(section.get(0).title).strip()).strip_code()
-            for snippet in snippets_in_section:
-                snippet.section = sectitle
-                snippets.append(snippet)
-        return snippets
+    def render_all(self, sections):
+        """
+        Convert a list of MarkedSections to HTML, using the HTML cache if we
+        have one. The sections that are not cached are converted with a single
+        API call if batch_section_rendering is enabled, falling back to one
+        call per section.
+
+        Returns a list with the HTML for each section, or None for those that
+        couldn't be converted.
+        """
+
+        htmls = self.get_cached_html(sections)
+        missing = [i for i, html in enumerate(htmls) if html is None]
+        to_render = [sections[i] for i in missing]
+
+        api_calls = 0
+        rendered = None
+        if self._cfg.batch_section_rendering and len(to_render) > 1:
+            rendered = self.render_batch(to_render)
+            api_calls += 1
+            if rendered is None:
+                self.stats.fallbacks['render_batch'] += 1
+        if rendered is None:
+            rendered = [self.render(section) for section in to_render]
+            api_calls += len(to_render)
+        self.stats.api_calls_per_article[api_calls] += 1
+
+        self.cache_html(to_render, rendered)
+        for i, html in zip(missing, rendered):
+            htmls[i] = html
+        return htmls
+
+    def get_cached_html(self, sections):
+        """
+        Returns a list with the cached HTML for each MarkedSection in
+        `sections`, or None for those that are not cached.
+        """
+
+        if self._html_cache is None:
+            return [None] * len(sections)
+        htmls = [
+            self._html_cache.get(self._html_cache_key(section))
+            for section in sections
+        ]
+        misses = htmls.count(None)
+        self.stats.html_cache_misses += misses
+        self.stats.html_cache_hits += len(htmls) - misses
+        return htmls
+
+    def cache_html(self, sections, htmls):
+        if self._html_cache is None:
+            return
+        for section, html in zip(sections, htmls):
+            if html is not None:
+                self._html_cache.put(self._html_cache_key(section), html)
+
+    def _html_cache_key(self, section):
+        return self._html_cache.make_key(
+            section.wikitext, self._cfg.html_parse_parameters)
+
+    def _parse_html(self, html):
+        return lxml.html.parse(
+            StringIO.StringIO(html),
+            parser = lxml.html.HTMLParser(
+                encoding = 'utf-8', remove_comments = True)).getroot()
+
+    def extract_from_html(self, section, html):
+        """
+        Extract the snippets from the HTML for a MarkedSection.
+
+        The return value is a list of Snippet objects.
+        """
+
+        with self.stats.timer('html_parse'):
+            tree = self._parse_html(html)
+        if tree is None: return []
+        with self.stats.timer('css_strip'):
+            self._strip_selectors(tree)
+        with self.stats.timer('find_snippets'):
+            snippet_roots = self._find_snippet_roots(tree)
+        with self.stats.timer('serialize_snippets'):
+            return self._serialize_snippets(section, snippet_roots)
+
+    def _strip_selectors(self, tree):
+        if self._html_xpath_to_strip is None:
+            return
+        for element in self._html_xpath_to_strip(tree):
+            lxml_utils.remove_element(element)
+
+    def _find_snippet_roots(self, tree):
+        snippet_roots = []
+        if self._cfg.extract == 'snippet':
+            # We climb up from each marker to the nearest antecessor element
+            # that we can use as a snippet.
+            for marker in tree.cssselect('.' + CITATION_NEEDED_MARKER_CLASS):
+                root = marker.getparent()
+                while root is not None and root.tag not in _SNIPPET_ROOT_TAGS:
+                    root = root.getparent()
+                if root is None:
+                    continue
+                if root.tag in _LIST_TAGS:
+                    snippet_roots.extend(self._html_list_to_snippets(root))
+                else:
+                    snippet_roots.append(self._make_snippet_root(root))
+        else:
+            # Throw away the actual template, we don't need it.
+            for marker in tree.cssselect('.' + CITATION_NEEDED_MARKER_CLASS):
+                lxml_utils.remove_element(marker)
+
+            # Keep only snippet root top-level elements within the body
+            # that have any text content (we may have created empty elements
+            # above during cleanup). This is not great as any content within,
+            # say, <blockquote> gets removed entirely, but it's good enough
+            # in most cases.
+            snippet_roots = [
+                self._make_snippet_root(*(
+                    e for e in tree.cssselect(
+                        'body > ' + ', '.join(_SNIPPET_ROOT_TAGS))
+                    if e.text_content() and not e.text_content().isspace()))
+            ]
+        return snippet_roots
+
+    def _serialize_snippets(self, section, snippet_roots):
+        minlen, maxlen = self._cfg.snippet_min_size, self._cfg.snippet_max_size
+        snippets_in_section = set()
+        for sr in snippet_roots:
+            snippet = Snippet()
+
+            # Some last-minute cleanup to shrink the snippet some more.
+            # Remove links and attributes, but make sure to keep the
+            # class in our marker elements, and that there is no space
+            # before it (which we need for the UI).
+            lxml.etree.strip_tags(sr, 'a')
+            markers_in_snippet = sr.cssselect(
+                '.' + CITATION_NEEDED_MARKER_CLASS)
+            lxml.etree.strip_attributes(sr, 'id', 'class', 'style')
+            sr.attrib['class'] = SNIPPET_WRAPPER_CLASS
+            for marker in markers_in_snippet:
+                marker.attrib['class'] = CITATION_NEEDED_MARKER_CLASS
+                tpl_id = marker.attrib[_TEMPLATE_ID_ATTR]
+                if section.template_data.get(tpl_id) is not None:
+                    snippet.dates = sorted(snippet.dates +
+                        [section.template_data[tpl_id]])
+                del marker.attrib[_TEMPLATE_ID_ATTR]
+                lxml_utils.strip_space_before_element(marker)
+
+            length = len(sr.text_content().strip())
+            self.stats.snippet_lengths[length] += 1
+            if minlen < length < maxlen:
+                snippet.snippet = d(lxml.html.tostring(
+                    sr, encoding = 'utf-8', method = 'html')).strip()
+                snippets_in_section.add(snippet)
+
+        for snippet in snippets_in_section:
+            snippet.section = section.title
+        return list(snippets_in_section)
 
     def _make_snippet_root(self, *child_elements):
         root = lxml.html.Element('div')
@@ -359,5 +601,5 @@ class SnippetParser:
     def _is_citation_needed(self, template):
         return template.name.lower().strip() in self._lowercase_cn_templates
 
-def create_snippet_parser(wikipedia, cfg):
-    return SnippetParser(wikipedia, cfg)
+def create_snippet_parser(wikipedia, cfg, html_cache = None):
+    return SnippetParser(wikipedia, cfg, html_cache)
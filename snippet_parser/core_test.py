@@ -1,8 +1,12 @@
 from . import core
+from . import html_cache
 
 import datetime
 import mock
 
+import os
+import shutil
+import tempfile
 import unittest
 
 _CN_EXPANSION = '^[citation_needed]'
@@ -18,6 +22,7 @@ class TestConfig(object):
     html_parse_parameters = {}
     citation_needed_templates = ['cn']
     html_css_selectors_to_strip = ['.noprint']
+    batch_section_rendering = True
 
 class SnippetParserTest(unittest.TestCase):
     def setUp(self):
@@ -128,6 +133,21 @@ class SnippetParserTest(unittest.TestCase):
         self.assertNotIn('Non-important', snippets[0].snippet)
         self.assertIn('Important stuff!', snippets[0].snippet)
 
+    def test_strip_multiple_css_selectors(self):
+        self._cfg.html_css_selectors_to_strip = ['.noprint', 'br', 'table']
+        self._sp = core.create_snippet_parser(self._wp, self._cfg)
+        _, snippets = self._do_extract(
+            '<table><tr><td>Table</td></tr></table>'
+            '<p><span class="a noprint b">Non-important</span> Stuff<br/>'
+            'with tail {citation_needed_tmpl}</p>',
+            '{{ cn }}', '<span class="noprint">Important<br/>stuff!</span>')
+
+        self.assertNotIn('Non-important', snippets[0].snippet)
+        self.assertNotIn('Table', snippets[0].snippet)
+        self.assertIn('Stuff', snippets[0].snippet)
+        self.assertIn('with tail', snippets[0].snippet)
+        self.assertIn('Important<br>stuff!', snippets[0].snippet)
+
     def test_strip_attributes(self):
         _, snippets = self._do_extract(
             '<p><span class="theclass">Stuff</span>{citation_needed_tmpl}</p>')
@@ -199,5 +219,145 @@ class SnippetParserTest(unittest.TestCase):
             'This{{cn|date=January 2020}} needs a reference{{cn}}')
         self.assertEqual(snippets[0].dates, [])
 
+class FastParseTest(unittest.TestCase):
+    def setUp(self):
+        self._sp = core.create_snippet_parser(mock.Mock(), TestConfig())
+
+    def test_keeps_only_sections_with_citation_needed(self):
+        wikicode = self._sp._fast_parse(
+            'Lead{{cn}}\n== A ==\nNo templates\n'
+            '== B ==\n{{other}} then {{ CN |date=x}}\n== C ==\nEnd')
+        self.assertEqual(str(wikicode),
+            'Lead{{cn}}\n== B ==\n{{other}} then {{ CN |date=x}}\n')
+
+    def test_keeps_last_section(self):
+        wikicode = self._sp._fast_parse('Lead\n== A ==\nEnd{{cn}}')
+        self.assertEqual(str(wikicode), '== A ==\nEnd{{cn}}')
+
+    def test_no_citation_needed(self):
+        self.assertIsNone(self._sp._fast_parse('Lead\n== A ==\n{{other}}'))
+
+class PrefilterTest(unittest.TestCase):
+    def setUp(self):
+        self._cfg = TestConfig()
+        self._cfg.citation_needed_templates = ['cn', 'Citation needed']
+        self._sp = core.create_snippet_parser(mock.Mock(), self._cfg)
+
+    def test_skips_articles_without_templates(self):
+        with mock.patch.object(self._sp, '_fast_parse') as fast_parse:
+            self.assertEqual(self._sp.prepare(
+                'Text {{Infobox|cn=1}} [[cn]] {{citation}}'), [])
+            self.assertFalse(fast_parse.called)
+        self.assertEqual(self._sp.stats.prefiltered_articles, 1)
+
+    def test_tolerates_whitespace_and_case(self):
+        for wikitext in ['{{cn}}', '{{ CN |date=x}}', '{{\n Citation Needed}}']:
+            self.assertEqual(len(self._sp.prepare('Text' + wikitext)), 1)
+        self.assertEqual(self._sp.stats.prefiltered_articles, 0)
+
+class BatchRenderingTest(unittest.TestCase):
+    _WIKITEXT = (
+        'First{{cn}}\n\n'
+        '== One ==\n\nSecond{{cn}}\n\n'
+        '== Two ==\n\nThird{{cn}}')
+
+    def setUp(self):
+        self._cfg = TestConfig()
+        self._wp = mock.Mock()
+        self._wp.parse.side_effect = self._fake_parse
+        self._sp = core.create_snippet_parser(self._wp, self._cfg)
+
+    def _fake_parse(self, params):
+        # Turn paragraphs into <p>, keeping HTML (our markers and separators)
+        # as is.
+        html = []
+        for paragraph in params['text'].split('\n\n'):
+            paragraph = paragraph.strip()
+            if not paragraph:
+                continue
+            if paragraph.startswith('=='):
+                html.append('<h2>%s</h2>' % paragraph.strip('= '))
+            elif paragraph.startswith('<div'):
+                html.append(paragraph)
+            else:
+                html.append('<p>%s</p>' % paragraph)
+        return {'parse': {'text': {'*': ''.join(html)}}}
+
+    def _snippet_texts(self, snippets):
+        return sorted(
+            (s.section, s.snippet.split('<p>')[1].split('<span')[0])
+            for s in snippets)
+
+    def test_single_api_call(self):
+        snippets = self._sp.extract(self._WIKITEXT)
+        self.assertEqual(self._wp.parse.call_count, 1)
+        self.assertEqual(self._snippet_texts(snippets), [
+            ('', 'First'), ('One', 'Second'), ('Two', 'Third')])
+        self.assertEqual(dict(self._sp.stats.api_calls_per_article), {1: 1})
+
+    def test_same_snippets_as_unbatched(self):
+        batched = self._sp.extract(self._WIKITEXT)
+        self._cfg.batch_section_rendering = False
+        unbatched = self._sp.extract(self._WIKITEXT)
+        self.assertEqual(self._wp.parse.call_count, 4)
+        self.assertEqual(set(batched), set(unbatched))
+        self.assertEqual(
+            dict(self._sp.stats.api_calls_per_article), {1: 1, 3: 1})
+
+    def test_fallback_when_split_fails(self):
+        # A section with an unclosed tag swallows the separator after it.
+        def parse(params):
+            html = self._fake_parse(params)
+            if 'data-ch-section-separator' in params['text']:
+                text = html['parse']['text']['*']
+                html['parse']['text']['*'] = '<div>%s</div>' % text.replace(
+                    '<h2>', '</div><h2>', 1)
+            return html
+        self._wp.parse.side_effect = parse
+        snippets = self._sp.extract(self._WIKITEXT)
+        self.assertEqual(self._wp.parse.call_count, 4)
+        self.assertEqual(len(snippets), 3)
+        self.assertEqual(dict(self._sp.stats.api_calls_per_article), {4: 1})
+
+    def test_fallback_when_api_fails(self):
+        def parse(params):
+            if 'data-ch-section-separator' in params['text']:
+                raise Exception()
+            return self._fake_parse(params)
+        self._wp.parse.side_effect = parse
+        snippets = self._sp.extract(self._WIKITEXT)
+        self.assertEqual(self._wp.parse.call_count, 4)
+        self.assertEqual(len(snippets), 3)
+        self.assertEqual(dict(self._sp.stats.errors), {'render': 1})
+        self.assertEqual(dict(self._sp.stats.fallbacks), {'render_batch': 1})
+
+    def test_html_cache(self):
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        cache = html_cache.HTMLCache(
+            os.path.join(cache_dir, 'html.sqlite'), 1024 * 1024, 3600)
+        self.addCleanup(cache.close)
+        self._sp = core.create_snippet_parser(self._wp, self._cfg, cache)
+
+        snippets = self._sp.extract(self._WIKITEXT)
+        self.assertEqual(self._wp.parse.call_count, 1)
+        self.assertEqual(set(snippets), set(self._sp.extract(self._WIKITEXT)))
+        self.assertEqual(self._wp.parse.call_count, 1)
+
+        # Only the changed section needs rendering.
+        self._sp.extract(self._WIKITEXT.replace('Third', 'Changed'))
+        self.assertEqual(self._wp.parse.call_count, 2)
+        self.assertNotIn(
+            'data-ch-section-separator', self._wp.parse.call_args[0][0]['text'])
+        self.assertEqual(self._sp.stats.html_cache_hits, 5)
+        self.assertEqual(self._sp.stats.html_cache_misses, 4)
+        self.assertEqual(
+            dict(self._sp.stats.api_calls_per_article), {0: 1, 1: 2})
+
+    def test_single_section_not_batched(self):
+        self._sp.extract('Only{{cn}}')
+        self.assertNotIn(
+            'data-ch-section-separator', self._wp.parse.call_args[0][0]['text'])
+
 if __name__ == '__main__':
     unittest.main()
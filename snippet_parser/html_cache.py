@@ -0,0 +1,134 @@
+'''
+A local cache of the HTML the Parse API returns for the sections of articles,
+so we don't have to render sections again if they didn't change since the
+last time we parsed them.
+'''
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+
+class HTMLCache(object):
+    '''
+    A size-bounded cache mapping the wikitext of a section (and the parameters
+    it is rendered with) to its HTML, stored compressed in a sqlite database.
+
+    Entries that haven't been used in a while are only removed when calling
+    evict(). Entries older than `max_age_s` are never returned, as the
+    rendering of the templates in them may have changed since they were
+    stored.
+
+    It can be shared by multiple threads, which take turns using the
+    underlying sqlite database.
+    '''
+
+    # Commit after this many writes.
+    _COMMIT_INTERVAL = 100
+
+    def __init__(self, path, max_size_bytes, max_age_s,
+            clock = time.time):
+        os.makedirs(os.path.dirname(path), exist_ok = True)
+        self._db = sqlite3.connect(path, check_same_thread = False)
+        self._lock = threading.Lock()
+        self._db.execute('''
+            CREATE TABLE IF NOT EXISTS html (
+                key BLOB PRIMARY KEY, html BLOB, size INTEGER,
+                created REAL, last_used REAL)
+        ''')
+        self._db.execute('''
+            CREATE INDEX IF NOT EXISTS html_last_used ON html (last_used)
+        ''')
+        self._max_size_bytes = max_size_bytes
+        self._max_age_s = max_age_s
+        self._clock = clock
+        self._pending_writes = 0
+
+    @staticmethod
+    def make_key(wikitext, params):
+        h = hashlib.sha1(wikitext.encode('utf-8'))
+        h.update(json.dumps(params, sort_keys = True).encode('utf-8'))
+        return h.digest()
+
+    def get(self, key):
+        now = self._clock()
+        with self._lock:
+            row = self._db.execute('''
+                SELECT html FROM html WHERE key = ? AND created > ?''',
+                (key, now - self._max_age_s)).fetchone()
+            if row is None:
+                return None
+            self._db.execute('''
+                UPDATE html SET last_used = ? WHERE key = ?''', (now, key))
+            self._maybe_commit()
+        return zlib.decompress(row[0]).decode('utf-8')
+
+    def put(self, key, html):
+        now = self._clock()
+        compressed = zlib.compress(html.encode('utf-8'))
+        with self._lock:
+            self._db.execute('''
+                INSERT OR REPLACE INTO html VALUES (?, ?, ?, ?, ?)''',
+                (key, compressed, len(key) + len(compressed), now, now))
+            self._maybe_commit()
+
+    def _maybe_commit(self):
+        self._pending_writes += 1
+        if self._pending_writes >= self._COMMIT_INTERVAL:
+            self._db.commit()
+            self._pending_writes = 0
+
+    def size(self):
+        with self._lock:
+            return self._size()
+
+    def _size(self):
+        return self._db.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM html').fetchone()[0]
+
+    def evict(self):
+        '''
+        Deletes expired entries, then the least recently used entries until
+        the cache fits within its maximum size. Returns the number of entries
+        deleted.
+        '''
+        with self._lock:
+            deleted = self._db.execute('''
+                DELETE FROM html WHERE created <= ?''',
+                (self._clock() - self._max_age_s,)).rowcount
+            excess = self._size() - self._max_size_bytes
+            if excess > 0:
+                keys = []
+                for key, size in self._db.execute('''
+                    SELECT key, size FROM html ORDER BY last_used'''):
+                    if excess <= 0:
+                        break
+                    keys.append((key,))
+                    excess -= size
+                self._db.executemany('DELETE FROM html WHERE key = ?', keys)
+                deleted += len(keys)
+            self._db.commit()
+            self._pending_writes = 0
+            if deleted:
+                # Actually give the space back to the filesystem.
+                self._db.execute('VACUUM')
+        return deleted
+
+    def close(self):
+        with self._lock:
+            self._db.commit()
+            self._db.close()
+
+def create_html_cache(cfg):
+    '''
+    Returns the HTMLCache for cfg.lang_code, or None if the cache is disabled.
+    '''
+    if not cfg.html_cache_max_size_mb:
+        return None
+    return HTMLCache(
+        os.path.join(cfg.cache_dir, 'html_cache_%s.sqlite' % cfg.lang_code),
+        cfg.html_cache_max_size_mb * 1024 * 1024,
+        cfg.html_cache_max_age_days * 24 * 3600)
@@ -0,0 +1,79 @@
+from . import html_cache
+
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+class HTMLCacheTest(unittest.TestCase):
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self._dir)
+        self._now = 1000.0
+        self._cache = self._make_cache()
+        self.addCleanup(lambda: self._cache.close())
+
+    def _make_cache(self, max_size_bytes = 1024 * 1024, max_age_s = 3600):
+        return html_cache.HTMLCache(
+            os.path.join(self._dir, 'cache', 'html.sqlite'), max_size_bytes,
+            max_age_s, clock = lambda: self._now)
+
+    def test_get_put(self):
+        key = self._cache.make_key('{{cn}}', {})
+        self.assertIsNone(self._cache.get(key))
+        self._cache.put(key, '<p>HTML</p>')
+        self.assertEqual(self._cache.get(key), '<p>HTML</p>')
+
+    def test_key_includes_params(self):
+        self.assertNotEqual(
+            self._cache.make_key('{{cn}}', {'variant': 'zh-hans'}),
+            self._cache.make_key('{{cn}}', {'variant': 'zh-hant'}))
+        self.assertEqual(
+            self._cache.make_key('{{cn}}', {'a': '1', 'b': '2'}),
+            self._cache.make_key('{{cn}}', {'b': '2', 'a': '1'}))
+
+    def test_persistent(self):
+        key = self._cache.make_key('{{cn}}', {})
+        self._cache.put(key, '<p>HTML</p>')
+        self._cache.close()
+        self._cache = self._make_cache()
+        self.assertEqual(self._cache.get(key), '<p>HTML</p>')
+
+    def test_expired(self):
+        key = self._cache.make_key('{{cn}}', {})
+        self._cache.put(key, '<p>HTML</p>')
+        self._now += 3601
+        self.assertIsNone(self._cache.get(key))
+        self.assertEqual(self._cache.evict(), 1)
+        self.assertEqual(self._cache.size(), 0)
+
+    def test_evict_least_recently_used(self):
+        keys = [self._cache.make_key(str(i), {}) for i in range(3)]
+        for key in keys:
+            self._cache.put(key, 'x' * 1000)
+            self._now += 1
+        self._cache.get(keys[0])
+        entry_size = self._cache.size() // 3
+        self._cache._max_size_bytes = 2 * entry_size
+        self.assertEqual(self._cache.evict(), 1)
+        self.assertIsNotNone(self._cache.get(keys[0]))
+        self.assertIsNone(self._cache.get(keys[1]))
+        self.assertIsNotNone(self._cache.get(keys[2]))
+
+    def test_shared_by_threads(self):
+        def put_and_get(i):
+            key = self._cache.make_key(str(i), {})
+            self._cache.put(key, str(i))
+            results[i] = self._cache.get(key)
+        results = [None] * 8
+        threads = [threading.Thread(target = put_and_get, args = (i,))
+            for i in range(len(results))]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(results, [str(i) for i in range(len(results))])
+
+if __name__ == '__main__':
+    unittest.main()
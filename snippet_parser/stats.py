@@ -1,14 +1,49 @@
 import collections
+import contextlib
+import time
 
 class SnippetParserStats(object):
     def __init__(self):
         self.snippet_lengths = collections.defaultdict(int)
+        self.api_calls_per_article = collections.defaultdict(int)
+        self.html_cache_hits = 0
+        self.html_cache_misses = 0
+        self.prefiltered_articles = 0
+        # Total time spent in each stage of SnippetParser, in seconds...
+        self.stage_seconds = collections.defaultdict(float)
+        # ...and a histogram of how long each run of a stage took, in ms.
+        self.stage_ms = collections.defaultdict(collections.Counter)
+        # How often we fell back to a slower path, and how often things
+        # failed, by stage.
+        self.fallbacks = collections.Counter()
+        self.errors = collections.Counter()
+
+    @contextlib.contextmanager
+    def timer(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.stage_seconds[stage] += elapsed
+            self.stage_ms[stage][int(elapsed * 1000)] += 1
 
 def merge_stats(stats):
     merged = SnippetParserStats()
     for s in stats:
         for length, count in list(s.snippet_lengths.items()):
             merged.snippet_lengths[length] += count
+        for calls, count in list(s.api_calls_per_article.items()):
+            merged.api_calls_per_article[calls] += count
+        merged.html_cache_hits += s.html_cache_hits
+        merged.html_cache_misses += s.html_cache_misses
+        merged.prefiltered_articles += s.prefiltered_articles
+        for stage, seconds in list(s.stage_seconds.items()):
+            merged.stage_seconds[stage] += seconds
+        for stage, histogram in list(s.stage_ms.items()):
+            merged.stage_ms[stage].update(histogram)
+        merged.fallbacks.update(s.fallbacks)
+        merged.errors.update(s.errors)
     return merged
 
 def percentile(distribution, p):
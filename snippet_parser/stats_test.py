@@ -0,0 +1,53 @@
+from . import stats
+
+import mock
+
+import unittest
+
+class SnippetParserStatsTest(unittest.TestCase):
+    def test_timer(self):
+        s = stats.SnippetParserStats()
+        with mock.patch('time.perf_counter', side_effect = [1.0, 1.25]):
+            with s.timer('render'):
+                pass
+        self.assertEqual(s.stage_seconds['render'], 0.25)
+        self.assertEqual(dict(s.stage_ms['render']), {250: 1})
+
+    def test_timer_exception(self):
+        s = stats.SnippetParserStats()
+        with self.assertRaises(ValueError):
+            with s.timer('render'):
+                raise ValueError()
+        self.assertEqual(sum(s.stage_ms['render'].values()), 1)
+
+    def test_merge_stats(self):
+        s1, s2 = stats.SnippetParserStats(), stats.SnippetParserStats()
+        s1.snippet_lengths[10] += 1
+        s2.snippet_lengths[10] += 2
+        s1.stage_seconds['tokenize'] = 1.0
+        s2.stage_seconds['tokenize'] = 2.0
+        s1.stage_ms['tokenize'][5] += 1
+        s2.stage_ms['tokenize'][5] += 1
+        s2.stage_ms['build'][1] += 1
+        s1.fallbacks['full_parse'] += 1
+        s2.errors['render'] += 3
+        s2.prefiltered_articles = 4
+
+        merged = stats.merge_stats([s1, s2])
+        self.assertEqual(dict(merged.snippet_lengths), {10: 3})
+        self.assertEqual(dict(merged.stage_seconds),
+            {'tokenize': 3.0})
+        self.assertEqual(dict(merged.stage_ms['tokenize']), {5: 2})
+        self.assertEqual(dict(merged.stage_ms['build']), {1: 1})
+        self.assertEqual(dict(merged.fallbacks), {'full_parse': 1})
+        self.assertEqual(dict(merged.errors), {'render': 3})
+        self.assertEqual(merged.prefiltered_articles, 4)
+
+    def test_percentile(self):
+        distribution = {1: 50, 2: 40, 10: 10}
+        self.assertEqual(stats.percentile(distribution, 50), 1)
+        self.assertEqual(stats.percentile(distribution, 90), 2)
+        self.assertEqual(stats.percentile(distribution, 99), 10)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,11 +1,13 @@
 import config
 
+import collections
 import errno
 import itertools as it
 import logging.handlers
 import os
 import sys
 import hashlib
+import threading
 
 def e(s):
     if type(s) == bytes:
@@ -57,6 +59,44 @@ def ichunk(iterable, chunk_size):
             return
         yield it1
 
+class LRUCache(object):
+    '''
+    A thread-safe mapping holding at most `max_size` entries, evicting the
+    least recently used ones first. Counts hits and misses in get().
+    '''
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default = None):
+        with self._lock:
+            try:
+                value = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last = False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
 def _setup_log_handler(logger, handler):
     handler.setFormatter(logging.Formatter(
         '%(asctime)s %(levelname)s: %(message)s [%(pathname)s:%(lineno)d]'))
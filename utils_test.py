@@ -0,0 +1,34 @@
+import utils
+
+import unittest
+
+class LRUCacheTest(unittest.TestCase):
+    def test_evicts_least_recently_used(self):
+        cache = utils.LRUCache(2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        # Touch 'a' so 'b' becomes the least recently used entry.
+        self.assertEqual(cache.get('a'), 1)
+        cache.put('c', 3)
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('c'), 3)
+
+    def test_hits_and_misses(self):
+        cache = utils.LRUCache(2)
+        cache.put('a', 1)
+        cache.get('a')
+        cache.get('a')
+        cache.get('b')
+        self.assertEqual((cache.hits, cache.misses), (2, 1))
+
+    def test_clear(self):
+        cache = utils.LRUCache(2)
+        cache.put('a', 1)
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.get('a', 'default'), 'default')
+
+if __name__ == '__main__':
+    unittest.main()